@@ -562,6 +562,19 @@ def objects():
             "check.py": get_plugin("check.py"),
             "lab.py": get_plugin("lab.py"),
             "create.py": get_plugin("create.py"),
+            "ocf.py": get_plugin("ocf.py"),
+            "autoreload.py": get_plugin("autoreload.py"),
+        },
+    }
+
+    # Helpers the plugins import, kept out of the plugins directory so that
+    # Sopel doesn't load them as a plugin of their own.
+    yield {
+        "apiVersion": "v1",
+        "kind": "ConfigMap",
+        "metadata": {"name": "sopel-lib"},
+        "data": {
+            "ocfplugins.py": Path(__file__).parent.joinpath("sopel", "lib", "ocfplugins.py").read_text(),
         },
     }
 
@@ -586,6 +599,7 @@ def objects():
                         {
                             "name": "sopel",
                             "image": get_image_tag("sopel"),
+                            "env": [{"name": "PYTHONPATH", "value": "/home/sopel/lib"}],
                             # Mount default.cfg to /home/sopel/.sopel/default.cfg
                             "volumeMounts": [
                                 {
@@ -601,6 +615,10 @@ def objects():
                                     "name": "sopel-plugins",
                                     "mountPath": "/home/sopel/.sopel/plugins/",
                                 },
+                                {
+                                    "name": "sopel-lib",
+                                    "mountPath": "/home/sopel/lib/",
+                                },
                             ],
                         }
                     ],
@@ -613,6 +631,10 @@ def objects():
                             "name": "sopel-plugins",
                             "configMap": {"name": "sopel-plugins"},
                         },
+                        {
+                            "name": "sopel-lib",
+                            "configMap": {"name": "sopel-lib"},
+                        },
                     ],
                 },
             },
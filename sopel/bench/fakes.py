@@ -0,0 +1,474 @@
+"""In-process stand-ins for the OCF services the plugins talk to.
+
+These replace ocflib's LDAP, NSS (grp), lab stats and account submission
+modules with fakes backed by a generated dataset, with a configurable delay
+on every call to model the network. Celery keeps its real client code, on
+kombu's in-memory transport and result backend, with a worker thread that
+runs the fake submission tasks.
+
+The bot side is faked too: FakeBot and FakeTrigger implement the parts of
+Sopel's bot and trigger that the plugins use, so handlers can be called
+directly.
+"""
+
+import random
+import socket
+import string
+import sys
+import threading
+import time
+import types
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+from sopel.config.types import BaseValidated
+from sopel.tools import SopelMemory
+
+
+OCF_LDAP_PEOPLE = "ou=People,dc=OCF,dc=Berkeley,dc=EDU"
+
+# default delay (in seconds) of each call to a backend
+LATENCY = {
+    # a search on an open LDAP connection, or one page of a paged search
+    "ldap": 0.002,
+    # TCP and TLS handshakes plus a bind
+    "ldap_connect": 0.02,
+    # grp.getgrgid, and grp.getgrall per 1000 groups (NSS is backed by LDAP)
+    "nss": 0.002,
+    # a query to the lab stats database
+    "labdb": 0.005,
+    # how long a worker takes to run a submission task
+    "worker": 0.01,
+}
+
+FIRST_NAMES = (
+    "alex", "ana", "ben", "carlos", "chen", "dana", "david", "elena", "emma",
+    "fatima", "grace", "hana", "ian", "jamal", "jin", "julia", "kai", "kevin",
+    "lena", "leo", "maria", "maya", "min", "nadia", "noah", "omar", "priya",
+    "quinn", "ravi", "rosa", "sam", "sara", "tariq", "tom", "uma", "victor",
+    "wei", "xin", "yara", "zoe",
+)
+LAST_NAMES = (
+    "adams", "baker", "chang", "diaz", "evans", "fischer", "garcia", "huang",
+    "ibrahim", "jones", "kim", "lee", "lopez", "martin", "nguyen", "okafor",
+    "patel", "quinn", "reyes", "smith", "tanaka", "usman", "vargas", "wang",
+    "wong", "xu", "yamamoto", "young", "zhang", "zhou",
+)
+# groups with a color in the check plugin, and how many members they get
+STAFF_GROUPS = {
+    "sorry": 100,
+    "opstaff": 40,
+    "ocfstaff": 60,
+    "ocfroot": 15,
+    "ocfapphost": 30,
+    "ocfofficers": 10,
+    "ocfalumni": 80,
+}
+OCF_GID = 20
+
+struct_group = namedtuple("struct_group", ("gr_name", "gr_passwd", "gr_gid", "gr_mem"))
+Session = namedtuple("Session", ("user", "host", "start", "end"))
+
+
+def pause(seconds):
+    if seconds > 0:
+        time.sleep(seconds)
+
+
+class Dataset:
+    """Accounts, groups, lab sessions and pending requests to serve."""
+
+    def __init__(self, users=10000, groups=2000, sessions=200, pending=20, seed=0):
+        rng = random.Random(seed)
+        now = datetime.now(timezone.utc)
+
+        self.users = {}
+        for i in range(users):
+            first = rng.choice(FIRST_NAMES)
+            last = rng.choice(LAST_NAMES)
+            uid = (first[0] + last)[:8]
+            while uid in self.users:
+                uid = (first[0] + last)[:5] + "".join(rng.choices(string.ascii_lowercase, k=3))
+            created = now - timedelta(days=rng.randrange(20 * 365))
+            self.users[uid] = {
+                "uid": [uid],
+                "cn": [f"{first.title()} {last.title()}"],
+                "uidNumber": 30000 + i,
+                "gidNumber": OCF_GID,
+                "homeDirectory": f"/home/{uid[0]}/{uid[:2]}/{uid}",
+                "loginShell": "/bin/bash",
+                "objectClass": ["ocfAccount", "account", "posixAccount"],
+                "creationTime": created,
+                "modifyTimestamp": created,
+            }
+        uids = list(self.users)
+
+        self.groups = [struct_group("ocf", "*", OCF_GID, [])]
+        for name, size in STAFF_GROUPS.items():
+            members = rng.sample(uids, min(size, len(uids)))
+            self.groups.append(struct_group(name, "*", 1000 + len(self.groups), members))
+        while len(self.groups) < groups:
+            members = rng.sample(uids, min(rng.randrange(1, 10), len(uids)))
+            self.groups.append(
+                struct_group(f"group{len(self.groups)}", "*", 1000 + len(self.groups), members),
+            )
+        self.groups_by_gid = {group.gr_gid: group for group in self.groups}
+
+        staff = set(next(group for group in self.groups if group.gr_name == "ocfstaff").gr_mem)
+        self.sessions = [
+            Session(
+                user=rng.choice(uids),
+                host="desktop{}".format(rng.randrange(1, 50)),
+                start=datetime.now() - timedelta(minutes=rng.randrange(300)),
+                end=None,
+            )
+            for _ in range(sessions)
+        ]
+        # make sure some staff are in the lab
+        for session in rng.sample(range(len(self.sessions)), min(10, sessions)):
+            self.sessions[session] = self.sessions[session]._replace(user=rng.choice(sorted(staff)))
+        self.staff_sessions = [session for session in self.sessions if session.user in staff]
+
+        self.pending = [
+            {
+                "id": i,
+                "user_name": f"newuser{i}",
+                "real_name": "{} {}".format(
+                    rng.choice(FIRST_NAMES).title(),
+                    rng.choice(LAST_NAMES).title(),
+                ),
+                "is_group": rng.random() < 0.1,
+                "calnet_uid": rng.randrange(10**6, 10**7),
+                "callink_oid": None,
+                "email": f"newuser{i}@berkeley.edu",
+                "reason": str(["Username is similar to an existing account"]),
+            }
+            for i in range(pending)
+        ]
+
+
+class FakeLDAPConnection:
+    """Enough of ldap3.Connection for the searches ocflib and the plugins do."""
+
+    def __init__(self, services):
+        self.dataset = services.dataset
+        self.latency = services.latency
+        self.calls = services.calls
+        self.bound = True
+        self.closed = False
+        self.response = None
+        self.extend = types.SimpleNamespace(
+            standard=types.SimpleNamespace(paged_search=self.paged_search),
+        )
+
+    def _match(self, search_filter):
+        users = self.dataset.users
+        if search_filter.startswith("(uid=") and "*" not in search_filter:
+            # equality on an indexed attribute, so not a scan
+            attrs = users.get(search_filter[5:-1])
+            return [attrs] if attrs is not None else []
+
+        if search_filter == "(uid=*)":
+            return list(users.values())
+
+        if "modifyTimestamp>=" in search_filter:
+            since = datetime.strptime(
+                search_filter.split("modifyTimestamp>=")[1][:14],
+                "%Y%m%d%H%M%S",
+            ).replace(tzinfo=timezone.utc)
+            return [attrs for attrs in users.values() if attrs["modifyTimestamp"] >= since]
+
+        keywords = [
+            part.split("*")[0]
+            for part in search_filter.split("(|(uid=*")[1:]
+        ]
+        if keywords:
+            return [
+                attrs
+                for attrs in users.values()
+                if all(
+                    keyword in attrs["uid"][0] or keyword in attrs["cn"][0].lower()
+                    for keyword in keywords
+                )
+            ]
+
+        raise ValueError(f"the fake LDAP server can't evaluate {search_filter}")
+
+    def _entries(self, search_filter, attributes):
+        for attrs in self._match(search_filter):
+            if attributes != "*":
+                attrs = {name: attrs[name] for name in attributes if name in attrs}
+            yield {
+                "dn": "uid={},{}".format(attrs.get("uid", ["?"])[0], OCF_LDAP_PEOPLE),
+                "attributes": attrs,
+                "type": "searchResEntry",
+            }
+
+    def search(self, base, search_filter, attributes=None, size_limit=0, **kwargs):
+        self.calls["ldap"] += 1
+        pause(self.latency["ldap"])
+        entries = list(self._entries(search_filter, attributes or ()))
+        self.response = entries[:size_limit] if size_limit else entries
+        return bool(self.response)
+
+    def paged_search(self, base, search_filter, attributes=None, paged_size=1000, generator=True, **kwargs):
+        entries = list(self._entries(search_filter, attributes or ()))
+        for start in range(0, max(len(entries), 1), paged_size):
+            self.calls["ldap"] += 1
+            pause(self.latency["ldap"])
+            yield from entries[start : start + paged_size]
+
+    def unbind(self):
+        self.bound = False
+        self.closed = True
+
+
+class FakeServices:
+    """The fake backends, sharing one dataset and one table of latencies."""
+
+    def __init__(self, dataset, latency=None):
+        self.dataset = dataset
+        self.latency = dict(LATENCY, **(latency or {}))
+        self.calls = {name: 0 for name in ("ldap_connect", "ldap", "nss", "labdb", "worker")}
+
+    # ocflib.infra.ldap
+
+    @contextmanager
+    def ldap_ocf(self):
+        self.calls["ldap_connect"] += 1
+        pause(self.latency["ldap_connect"])
+        conn = FakeLDAPConnection(self)
+        try:
+            yield conn
+        finally:
+            conn.unbind()
+
+    # ocflib.account.search
+
+    def user_attrs(self, uid, connection=None, base=OCF_LDAP_PEOPLE):
+        with (connection or self.ldap_ocf)() as c:
+            c.search(base, f"(uid={uid})", attributes="*")
+            if len(c.response) > 0:
+                return c.response[0]["attributes"]
+
+    # grp
+
+    def getgrall(self):
+        self.calls["nss"] += 1
+        pause(self.latency["nss"] * max(len(self.dataset.groups) / 1000, 1))
+        return list(self.dataset.groups)
+
+    def getgrgid(self, gid):
+        self.calls["nss"] += 1
+        pause(self.latency["nss"])
+        try:
+            return self.dataset.groups_by_gid[gid]
+        except KeyError:
+            raise KeyError(f"getgrgid(): gid not found: {gid}") from None
+
+    # ocflib.lab.stats
+
+    def staff_in_lab(self):
+        self.calls["labdb"] += 1
+        pause(self.latency["labdb"])
+        return list(self.dataset.staff_sessions)
+
+    def users_in_lab_count(self):
+        self.calls["labdb"] += 1
+        pause(self.latency["labdb"])
+        return len(self.dataset.sessions)
+
+    # ocflib.account.submission
+
+    def get_tasks(self, celery_app, credentials=None):
+        def run_task(result):
+            self.calls["worker"] += 1
+            pause(self.latency["worker"])
+            return result
+
+        @celery_app.task(name="ocflib.account.submission.get_pending_requests")
+        def get_pending_requests():
+            return run_task(list(self.dataset.pending))
+
+        @celery_app.task(name="ocflib.account.submission.approve_request")
+        def approve_request(request_id):
+            return run_task(None)
+
+        @celery_app.task(name="ocflib.account.submission.reject_request")
+        def reject_request(request_id):
+            return run_task(None)
+
+        return types.SimpleNamespace(
+            get_pending_requests=get_pending_requests,
+            approve_request=approve_request,
+            reject_request=reject_request,
+        )
+
+    def install(self):
+        """Put fake ocflib modules in sys.modules, in place of the real ones.
+
+        This has to happen before the plugins are imported. The plugins' grp
+        module is replaced separately, with patch_grp.
+        """
+        modules = {
+            name: types.ModuleType(name)
+            for name in (
+                "ocflib",
+                "ocflib.account",
+                "ocflib.account.search",
+                "ocflib.account.submission",
+                "ocflib.infra",
+                "ocflib.infra.ldap",
+                "ocflib.lab",
+                "ocflib.lab.stats",
+            )
+        }
+        modules["ocflib.account.search"].user_attrs = self.user_attrs
+        modules["ocflib.account.submission"].get_tasks = self.get_tasks
+        modules["ocflib.infra.ldap"].ldap_ocf = self.ldap_ocf
+        modules["ocflib.infra.ldap"].OCF_LDAP_PEOPLE = OCF_LDAP_PEOPLE
+        modules["ocflib.lab.stats"].Session = Session
+        modules["ocflib.lab.stats"].staff_in_lab = self.staff_in_lab
+        modules["ocflib.lab.stats"].users_in_lab_count = self.users_in_lab_count
+        for name, module in modules.items():
+            parent, _, child = name.rpartition(".")
+            if parent:
+                setattr(modules[parent], child, module)
+        sys.modules.update(modules)
+
+        try:
+            import ldap3.core.exceptions  # noqa: F401
+        except ImportError:
+            exceptions = types.ModuleType("ldap3.core.exceptions")
+            exceptions.LDAPException = type("LDAPException", (Exception,), {})
+            for name in ("LDAPCommunicationError", "LDAPResponseTimeoutError"):
+                setattr(exceptions, name, type(name, (exceptions.LDAPException,), {}))
+            sys.modules["ldap3.core.exceptions"] = exceptions
+
+    def patch_grp(self, module):
+        """Make a loaded plugin module look groups up in the fake NSS."""
+        module.grp = types.SimpleNamespace(
+            getgrall=self.getgrall,
+            getgrgid=self.getgrgid,
+        )
+
+
+class FakeWorker:
+    """Celery worker threads running tasks off of the in-memory broker.
+
+    Celery's own worker wants to own the process (signals, pools), so this
+    consumes task messages with kombu directly and stores results in the
+    app's result backend.
+    """
+
+    def __init__(self, app, concurrency=1):
+        self.app = app
+        self.concurrency = concurrency
+        self._stop = threading.Event()
+
+    def start(self):
+        for _ in range(self.concurrency):
+            threading.Thread(target=self._consume, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _consume(self):
+        queue = self.app.amqp.queues[self.app.conf.task_default_queue]
+        with self.app.connection_for_read() as conn:
+            with conn.Consumer(queue, callbacks=[self._run], accept={"pickle", "json", "msgpack"}):
+                while not self._stop.is_set():
+                    try:
+                        conn.drain_events(timeout=0.1)
+                    except socket.timeout:
+                        pass
+
+    def _run(self, body, message):
+        args, kwargs, _ = body
+        task_id = message.headers["id"]
+        task = self.app.tasks[message.headers["task"]]
+        try:
+            result = task.run(*args, **kwargs)
+        except Exception as ex:
+            self.app.backend.mark_as_failure(task_id, ex)
+        else:
+            self.app.backend.mark_as_done(task_id, result)
+        message.ack()
+
+
+class FakeSettings:
+    """Sopel's settings, with sections filled in from their defaults."""
+
+    def __init__(self, homedir, overrides=None):
+        self._overrides = overrides or {}
+        self.core = types.SimpleNamespace(
+            homedir=homedir,
+            nick="ocfbench",
+            help_prefix="!",
+            owner="bench",
+            admins=["bench"],
+        )
+
+    def define_section(self, name, cls, validate=True):
+        section = types.SimpleNamespace()
+        for attr in dir(cls):
+            option = getattr(cls, attr)
+            if isinstance(option, BaseValidated):
+                setattr(section, attr, option.default)
+        for attr, value in self._overrides.get(name, {}).items():
+            setattr(section, attr, value)
+        setattr(self, name, section)
+
+
+class FakeBot:
+    """The parts of SopelWrapper the plugins use; messages are counted, not sent."""
+
+    def __init__(self, settings, channels=("#bench",)):
+        self.settings = settings
+        self.memory = SopelMemory()
+        self.channels = {channel: None for channel in channels}
+        self.nick = "ocfbench"
+        self._lock = threading.Lock()
+        self.sent = 0
+
+    def say(self, message, destination=None, max_messages=1, truncation="", trailing=""):
+        with self._lock:
+            self.sent += 1
+
+    def reply(self, message, destination=None, reply_to=None, notice=False):
+        self.say(message, destination)
+
+
+class FakeTrigger:
+    """A message matched against a handler's command or rule.
+
+    For commands, groups follow Sopel: 1 is the command, 2 everything after
+    it and 3 to 6 the first arguments. For rules, groups are the regex's.
+    """
+
+    def __init__(self, text, match=None, nick="bench", sender="#bench"):
+        self.text = text
+        self.match = match
+        self.nick = nick
+        self.sender = sender
+        self.admin = True
+        self.owner = True
+
+    @classmethod
+    def command(cls, text, **kwargs):
+        command, _, args = text.lstrip("!").partition(" ")
+        words = args.split()
+        groups = [text, command, args or None] + [
+            words[i] if i < len(words) else None for i in range(4)
+        ]
+        trigger = cls(text, **kwargs)
+        trigger._groups = groups
+        return trigger
+
+    def group(self, n=0):
+        if self.match is not None:
+            return self.match.group(n)
+        return self._groups[n]
@@ -0,0 +1,247 @@
+"""Benchmark the plugins' command handlers against in-process fakes.
+
+Loads the plugins with ocflib, NSS and the Celery broker replaced by the
+fakes in fakes.py, waits for their caches to warm up, then calls each
+handler in turn with a fake trigger and reports throughput and latency per
+command. Run it with the same Python environment as the bot:
+
+    python sopel/bench/handlers.py
+    python sopel/bench/handlers.py --latency ldap=0.01 --users 50000
+
+Every backend call sleeps for its configured latency, so the numbers are
+only comparable between runs with the same settings. None of the commands
+should raise, so it exits with status 1 if any of them did.
+"""
+
+import argparse
+import importlib.util
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+from fakes import Dataset
+from fakes import FakeBot
+from fakes import FakeServices
+from fakes import FakeSettings
+from fakes import FakeTrigger
+from fakes import FakeWorker
+from fakes import LATENCY
+
+
+PLUGINS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "plugins")
+# the plugins import their shared helpers from here, which the bot has on its
+# PYTHONPATH
+LIB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "lib")
+sys.path.insert(0, LIB_DIR)
+# in setup order: ocf first, so the others find its command stats
+PLUGINS = ("ocf", "check", "lab", "create")
+
+# how long (in seconds) to wait for the plugins' caches to load
+WARMUP_TIMEOUT = 60
+
+
+def load_plugins(services, names=PLUGINS):
+    """Import the plugins from their files, like Sopel's PyFilePlugin does."""
+    services.install()
+    plugins = {}
+    for name in names:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(PLUGINS_DIR, f"{name}.py"))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+        plugins[name] = module
+    services.patch_grp(plugins["check"])
+    return plugins
+
+
+def make_bot(args):
+    settings = FakeSettings(
+        args.homedir or tempfile.mkdtemp(prefix="ocfbench-"),
+        {
+            "celery": {"broker": "memory://", "backend": "cache+memory://"},
+            "lab": {"poll_interval": args.lab_poll_interval},
+        },
+    )
+    return FakeBot(settings)
+
+
+def warm_up(bot):
+    """Wait for the background loads the plugins start in setup."""
+    ready = {
+        "group index": lambda: bot.memory["check_groups"].age() is not None,
+        "search index": lambda: bot.memory["check_accounts"].ready,
+        "pending requests": lambda: bot.memory["create_pending"].seeded,
+    }
+    deadline = time.monotonic() + WARMUP_TIMEOUT
+    started = time.monotonic()
+    for name, is_ready in ready.items():
+        while not is_ready():
+            if time.monotonic() > deadline:
+                sys.exit(f"timed out waiting for the {name} to load")
+            time.sleep(0.01)
+        print(f"{name} loaded after {time.monotonic() - started:.2f}s")
+
+
+def cases(plugins, dataset, rng):
+    """Return (label, handler, make_trigger) for each benchmarked command."""
+    uids = list(dataset.users)
+    staff = sorted({session.user for session in dataset.staff_sessions})
+
+    def command(text):
+        return lambda: FakeTrigger.command(text())
+
+    def rule(handler, text):
+        patterns = [re.compile(pattern, re.IGNORECASE) for pattern in handler.rule]
+
+        def make():
+            message = text()
+            match = next(filter(None, (pattern.match(message) for pattern in patterns)))
+            return FakeTrigger(message, match)
+
+        return make
+
+    check, lab, create = plugins["check"], plugins["lab"], plugins["create"]
+    return [
+        ("check", check.check, command(lambda: "!check " + rng.choice(uids))),
+        # a few accounts checked over and over, so mostly cache hits
+        ("check (hot)", check.check, command(lambda: "!check " + rng.choice(uids[:50]))),
+        ("check (missing)", check.check, command(lambda: f"!check nobody{rng.randrange(10**6)}")),
+        ("check --fresh", check.check, command(lambda: "!check --fresh " + rng.choice(uids))),
+        ("checkacct", check.checkacct, command(lambda: "!checkacct " + rng.choice(uids)[:4])),
+        (
+            "checkacct (name)",
+            check.checkacct,
+            command(lambda: "!checkacct " + " ".join(rng.choice(dataset.users[rng.choice(uids)]["cn"]).split())),
+        ),
+        ("more", check.more, command(lambda: "!more")),
+        ("witl", lab.who_is_in_lab, rule(lab.who_is_in_lab, lambda: "witl")),
+        ("in lab", lab.in_lab, rule(lab.in_lab, lambda: f"is {rng.choice(staff)} in the lab")),
+        ("list", create.list_pending, command(lambda: "!list")),
+        ("approve", create.approve, command(lambda: f"!approve newuser{rng.randrange(100)}")),
+    ]
+
+
+def run(handler, make_trigger, bot, number):
+    """Call a handler number times, returning its latencies and error count."""
+    latencies = []
+    errors = 0
+    for _ in range(number):
+        trigger = make_trigger()
+        start = time.perf_counter()
+        try:
+            handler(bot, trigger)
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - start)
+    return latencies, errors
+
+
+def report(label, latencies, errors):
+    total = sum(latencies)
+    if len(latencies) > 1:
+        quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    else:
+        quantiles = latencies * 99
+    print(
+        "{:<18} {:>7} {:>6} {:>10.0f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+            label,
+            len(latencies),
+            errors,
+            len(latencies) / total if total else 0,
+            quantiles[49] * 1e3,
+            quantiles[94] * 1e3,
+            quantiles[98] * 1e3,
+            max(latencies) * 1e3,
+        ),
+    )
+
+
+def parse_latency(value):
+    name, _, seconds = value.partition("=")
+    if name not in LATENCY:
+        raise argparse.ArgumentTypeError(
+            "unknown backend {!r}, pick one of {}".format(name, ", ".join(LATENCY)),
+        )
+    return name, float(seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=500, help="calls per command")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--groups", type=int, default=2000)
+    parser.add_argument("--sessions", type=int, default=200, help="lab sessions")
+    parser.add_argument("--pending", type=int, default=20, help="pending account requests")
+    parser.add_argument(
+        "--latency",
+        type=parse_latency,
+        action="append",
+        default=[],
+        metavar="BACKEND=SECONDS",
+        help="backend latency, defaults: {}".format(
+            ", ".join(f"{name}={seconds}" for name, seconds in LATENCY.items()),
+        ),
+    )
+    parser.add_argument(
+        "--lab-poll-interval",
+        type=float,
+        default=0,
+        help="lab plugin poll interval, 0 to query on demand (default: 0)",
+    )
+    parser.add_argument("--workers", type=int, default=1, help="fake Celery worker threads")
+    parser.add_argument(
+        "--homedir",
+        help="bot home directory; reuse one to start with the caches the last run saved "
+        "(default: a new temporary directory)",
+    )
+    parser.add_argument("--only", nargs="+", metavar="LABEL", help="only run these commands")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    dataset = Dataset(args.users, args.groups, args.sessions, args.pending, args.seed)
+    services = FakeServices(dataset, dict(args.latency))
+    plugins = load_plugins(services)
+    bot = make_bot(args)
+
+    for name in PLUGINS:
+        plugins[name].setup(bot)
+    worker = FakeWorker(plugins["create"].celery_app(bot), args.workers)
+    worker.start()
+    warm_up(bot)
+
+    print(
+        "{:<18} {:>7} {:>6} {:>10} {:>9} {:>9} {:>9} {:>9}".format(
+            "command", "calls", "errors", "calls/s", "p50 (ms)", "p95 (ms)", "p99 (ms)", "max (ms)",
+        ),
+    )
+    failed = []
+    for label, handler, make_trigger in cases(plugins, dataset, rng):
+        if args.only and label not in args.only:
+            continue
+        latencies, errors = run(handler, make_trigger, bot, args.number)
+        report(label, latencies, errors)
+        if errors:
+            failed.append(label)
+
+    print()
+    print("backend calls: " + ", ".join(f"{name} {count}" for name, count in services.calls.items()))
+    for section, lines in bot.memory.get("stats", {}).items():
+        for line in lines(bot):
+            print(f"{section}: {line}")
+
+    worker.stop()
+    for name in reversed(PLUGINS):
+        if hasattr(plugins[name], "shutdown"):
+            plugins[name].shutdown(bot)
+
+    if failed:
+        sys.exit("commands that raised: {}".format(", ".join(failed)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,412 @@
+"""Load test the plugins through a real Sopel bot and a fake IRC server.
+
+Runs Sopel with the plugins against a local fake ircd, with the backends
+replaced by the fakes in fakes.py, then sends a Poisson stream of messages
+(a configurable mix of !check, !checkacct, witl and !list) at a given rate
+and reports, per command:
+
+- dispatch delay: from the ircd sending a message to Sopel dispatching it,
+  i.e. how far the bot's read loop is behind
+- queueing delay: from dispatch to the handler thread starting
+- reply latency: from the ircd sending a message to it getting the first
+  line of the reply
+
+as well as how many handler threads were running at once. Every message
+comes from a new nick, in a private message, so replies can be told apart.
+Run it with the same Python environment as the bot:
+
+    python sopel/bench/loadtest.py --rate 50 --duration 30
+    python sopel/bench/loadtest.py --mix check=1 --rate 200 --flood
+
+Flood protection is off unless --flood is given, so that the numbers are
+about the handlers rather than about Sopel pacing its replies.
+"""
+
+import argparse
+import os
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from fakes import Dataset
+from fakes import FakeServices
+from fakes import FakeWorker
+from handlers import parse_latency
+from handlers import PLUGINS
+from handlers import PLUGINS_DIR
+from handlers import warm_up
+
+NICK = "ocfbench"
+CHANNEL = "#bench"
+SERVER = "fake.ircd"
+
+# how often (in seconds) the number of running handlers is sampled
+SAMPLE_INTERVAL = 0.01
+
+
+class FakeIRCd:
+    """Just enough of an IRC server for one Sopel client to connect and talk."""
+
+    def __init__(self):
+        self.sock = socket.create_server(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.conn = None
+        self.joined = threading.Event()
+        self._send_lock = threading.Lock()
+        self.on_reply = None
+
+    def serve(self):
+        self.conn, _ = self.sock.accept()
+        buffer = b""
+        while True:
+            try:
+                data = self.conn.recv(65536)
+            except OSError:
+                # closed on QUIT
+                return
+            if not data:
+                return
+            buffer += data
+            *lines, buffer = buffer.split(b"\r\n")
+            for line in lines:
+                self._handle(line.decode("utf-8", "replace"))
+
+    def send(self, line):
+        with self._send_lock:
+            self.conn.sendall(line.encode() + b"\r\n")
+
+    def _handle(self, line):
+        command, _, params = line.partition(" ")
+        if command == "PRIVMSG":
+            target, _, text = params.partition(" :")
+            if self.on_reply is not None:
+                self.on_reply(target, text)
+        elif command == "USER":
+            for reply in (
+                f"001 {NICK} :Welcome to the fake IRC server",
+                f"005 {NICK} CHANTYPES=# PREFIX=(ov)@+ NICKLEN=30 :are supported",
+                f"376 {NICK} :End of /MOTD command.",
+            ):
+                self.send(f":{SERVER} {reply}")
+        elif command == "CAP":
+            self.send(f":{SERVER} 421 {NICK} CAP :Unknown command")
+        elif command == "JOIN":
+            channel = params.split()[0]
+            self.send(f":{NICK}!{NICK}@bench JOIN {channel}")
+            self.send(f":{SERVER} 353 {NICK} = {channel} :{NICK}")
+            self.send(f":{SERVER} 366 {NICK} {channel} :End of /NAMES list.")
+            self.joined.set()
+        elif command == "WHO":
+            self.send(f":{SERVER} 315 {NICK} {params.split()[0]} :End of /WHO list.")
+        elif command == "QUIT":
+            self.conn.close()
+        elif command == "PING":
+            self.send(f":{SERVER} PONG {SERVER} {params}")
+
+    def privmsg(self, nick, text):
+        self.send(f":{nick}!{nick}@freshmen.berkeley.edu PRIVMSG {NICK} :{text}")
+
+
+class Recorder:
+    """Timestamps of each message on its way through the bot."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # nick -> [kind, sent, dispatched, started, replied, reply lines]
+        self.messages = {}
+        self.running = 0
+        self.samples = []
+
+    def sent(self, nick, kind):
+        with self._lock:
+            self.messages[nick] = [kind, time.monotonic(), None, None, None, 0]
+
+    def _mark(self, nick, field):
+        now = time.monotonic()
+        with self._lock:
+            message = self.messages.get(nick)
+            if message is not None and message[field] is None:
+                message[field] = now
+
+    def replied(self, nick, text):
+        self._mark(nick, 4)
+        with self._lock:
+            message = self.messages.get(nick)
+            if message is not None:
+                message[5] += 1
+
+    def instrument(self, bot):
+        """Wrap the bot's dispatch and call_rule to timestamp each message."""
+        dispatch = bot.dispatch
+        call_rule = bot.call_rule
+
+        def timed_dispatch(pretrigger):
+            if pretrigger.event == "PRIVMSG":
+                self._mark(str(pretrigger.nick), 2)
+            dispatch(pretrigger)
+
+        def timed_call_rule(rule, sopel, trigger):
+            if rule.get_plugin_name() not in PLUGINS:
+                return call_rule(rule, sopel, trigger)
+            self._mark(str(trigger.nick), 3)
+            with self._lock:
+                self.running += 1
+            try:
+                return call_rule(rule, sopel, trigger)
+            finally:
+                with self._lock:
+                    self.running -= 1
+
+        bot.dispatch = timed_dispatch
+        bot.call_rule = timed_call_rule
+
+    def sample(self, stop):
+        while not stop.is_set():
+            self.samples.append((self.running, threading.active_count()))
+            stop.wait(SAMPLE_INTERVAL)
+
+
+def write_config(homedir, port, admins, flood, lab_poll_interval):
+    path = os.path.join(homedir, "loadtest.cfg")
+    with open(path, "w") as f:
+        f.write(
+            "\n".join(
+                (
+                    "[core]",
+                    f"nick = {NICK}",
+                    "host = 127.0.0.1",
+                    f"port = {port}",
+                    "use_ssl = false",
+                    f"owner = {NICK}",
+                    f"admins = {admins}",
+                    f"channels = {CHANNEL}",
+                    f"homedir = {homedir}",
+                    f"extra = {os.path.abspath(PLUGINS_DIR)}",
+                    "enable =",
+                    *(f"    {name}" for name in PLUGINS),
+                    "logging_level = WARNING",
+                    "prefix = \\!",
+                    "help_prefix = !",
+                    "" if flood else "flood_max_wait = 0",
+                    "",
+                    "[celery]",
+                    "broker = memory://",
+                    "backend = cache+memory://",
+                    "",
+                    "[lab]",
+                    f"poll_interval = {lab_poll_interval}",
+                    "",
+                ),
+            ),
+        )
+    return path
+
+
+def traffic(dataset, rng):
+    """Return a function making the text of a message of each kind."""
+    uids = list(dataset.users)
+    return {
+        "check": lambda: "!check " + rng.choice(uids),
+        "checkacct": lambda: "!checkacct " + rng.choice(uids)[:4],
+        "witl": lambda: "witl",
+        "list": lambda: "!list",
+    }
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in ("check", "checkacct", "witl", "list"):
+            raise argparse.ArgumentTypeError(f"unknown message kind {kind!r}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def quantiles(values):
+    if not values:
+        return "{:>8} {:>8} {:>8} {:>8}".format(*("-",) * 4)
+    if len(values) == 1:
+        values = values * 2
+    q = statistics.quantiles(values, n=100, method="inclusive")
+    return "{:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f}".format(
+        q[49] * 1e3,
+        q[94] * 1e3,
+        q[98] * 1e3,
+        max(values) * 1e3,
+    )
+
+
+def report(recorder, elapsed):
+    by_kind = defaultdict(list)
+    for message in recorder.messages.values():
+        by_kind[message[0]].append(message)
+
+    header = "{:>8} {:>8} {:>8} {:>8}"
+    print(
+        ("{:<10} {:>6} {:>6} {:>7}  " + header + "  " + header + "  " + header).format(
+            "command", "sent", "lost", "lines",
+            "dispatch", "p95", "p99", "max",
+            "queue", "p95", "p99", "max",
+            "reply", "p95", "p99", "max",
+        ),
+    )
+    for kind, messages in sorted(by_kind.items()):
+        replied = [m for m in messages if m[4] is not None]
+        print(
+            "{:<10} {:>6} {:>6} {:>7}  {}  {}  {}".format(
+                kind,
+                len(messages),
+                len(messages) - len(replied),
+                sum(m[5] for m in messages),
+                quantiles([m[2] - m[1] for m in messages if m[2] is not None]),
+                quantiles([m[3] - m[2] for m in messages if m[3] is not None and m[2] is not None]),
+                quantiles([m[4] - m[1] for m in replied]),
+            ),
+        )
+    print("(milliseconds: p50, p95, p99 and max of each delay)")
+
+    total = len(recorder.messages)
+    replied = [m for m in recorder.messages.values() if m[4] is not None]
+    if replied:
+        # from the first message sent to the last reply received
+        answering = max(m[4] for m in replied) - min(m[1] for m in recorder.messages.values())
+    else:
+        answering = elapsed
+    running = [sample[0] for sample in recorder.samples] or [0]
+    threads = [sample[1] for sample in recorder.samples] or [0]
+    print()
+    print(
+        "offered {:.1f} msg/s over {:.1f}s, answered {:.1f} msg/s over {:.1f}s".format(
+            total / elapsed,
+            elapsed,
+            len(replied) / answering,
+            answering,
+        ),
+    )
+    print(
+        "handler threads: mean {:.1f}, p99 {}, peak {}; process threads peak {}".format(
+            statistics.mean(running),
+            sorted(running)[int(len(running) * 0.99)],
+            max(running),
+            max(threads),
+        ),
+    )
+
+
+def drive(args, bot, ircd, recorder, texts, rng):
+    """Send the traffic once the bot is ready, then report and stop the bot."""
+    if not ircd.joined.wait(30):
+        print("the bot didn't connect to the fake ircd")
+        os._exit(1)
+    warm_up(bot)
+
+    kinds = list(args.mix)
+    weights = [args.mix[kind] for kind in kinds]
+
+    stop_sampling = threading.Event()
+    threading.Thread(target=recorder.sample, args=(stop_sampling,), daemon=True).start()
+
+    print(f"sending {args.rate:g} msg/s for {args.duration:g}s")
+    start = time.monotonic()
+    next_send = start
+    i = 0
+    while next_send - start < args.duration:
+        time.sleep(max(next_send - time.monotonic(), 0))
+        kind = rng.choices(kinds, weights)[0]
+        nick = f"fresh{i}"
+        recorder.sent(nick, kind)
+        ircd.privmsg(nick, texts[kind]())
+        i += 1
+        next_send += rng.expovariate(args.rate)
+    elapsed = time.monotonic() - start
+
+    deadline = time.monotonic() + args.drain
+    while time.monotonic() < deadline and any(
+        message[4] is None for message in list(recorder.messages.values())
+    ):
+        time.sleep(0.1)
+    stop_sampling.set()
+
+    print()
+    report(recorder, elapsed)
+    bot.quit("load test done")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, default=20, help="messages per second")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of traffic")
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default="check=4,checkacct=2,witl=3,list=1",
+        help="relative weight of each message kind (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--drain",
+        type=float,
+        default=10,
+        help="seconds to wait for replies after the traffic stops",
+    )
+    parser.add_argument("--flood", action="store_true", help="keep Sopel's flood protection on")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--groups", type=int, default=2000)
+    parser.add_argument("--sessions", type=int, default=200, help="lab sessions")
+    parser.add_argument("--pending", type=int, default=20, help="pending account requests")
+    parser.add_argument(
+        "--latency",
+        type=parse_latency,
+        action="append",
+        default=[],
+        metavar="BACKEND=SECONDS",
+        help="backend latency, as in handlers.py",
+    )
+    parser.add_argument("--lab-poll-interval", type=float, default=10)
+    parser.add_argument("--workers", type=int, default=1, help="fake Celery worker threads")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    dataset = Dataset(args.users, args.groups, args.sessions, args.pending, args.seed)
+    services = FakeServices(dataset, dict(args.latency))
+    services.install()
+
+    # imported late, so that the plugins Sopel loads get the fake ocflib
+    from sopel import bot as sopel_bot
+    from sopel import config
+
+    ircd = FakeIRCd()
+    homedir = tempfile.mkdtemp(prefix="ocfbench-")
+    settings = config.Config(
+        write_config(homedir, ircd.port, "fresh*", args.flood, args.lab_poll_interval),
+    )
+    bot = sopel_bot.Sopel(settings)
+    recorder = Recorder()
+    recorder.instrument(bot)
+    ircd.on_reply = recorder.replied
+
+    bot.setup()
+    check = sys.modules["check"]
+    services.patch_grp(check)
+    # the group index may have been built from the real grp before the patch
+    bot.memory["check_groups"].refresh()
+    FakeWorker(sys.modules["create"].celery_app(bot), args.workers).start()
+
+    threading.Thread(target=ircd.serve, daemon=True).start()
+    threading.Thread(
+        target=drive,
+        args=(args, bot, ircd, recorder, traffic(dataset, rng), rng),
+        daemon=True,
+    ).start()
+    # Sopel installs signal handlers, so it has to run in the main thread
+    bot.run("127.0.0.1", ircd.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Compare Celery serializers on the create plugin's task traffic.
+
+Measures encode and decode time and payload size, through kombu's serializer
+registry (the same code path Celery uses), for approve_request arguments and
+for get_pending_requests results of various sizes. Run it with the same
+Python environment as the bot:
+
+    python sopel/bench/serializers.py
+
+Today workers return pickled StoredNewAccountRequest rows (the "pickle-orm"
+rows, only measured if ocflib is installed). With JSON or msgpack they would
+have to return plain dicts instead, which leave out the encrypted password
+like NewAccountRequest.to_dict does.
+"""
+
+import argparse
+import random
+import string
+import timeit
+
+from kombu.serialization import dumps
+from kombu.serialization import loads
+
+try:
+    from ocflib.account.submission import StoredNewAccountRequest
+except ImportError:
+    StoredNewAccountRequest = None
+
+
+SERIALIZERS = ("pickle", "json", "msgpack")
+
+
+def fake_row(i):
+    """Fields of a pending request, as stored in ocflib's database."""
+    user_name = "".join(random.choices(string.ascii_lowercase, k=8))
+    return {
+        "id": i,
+        "user_name": user_name,
+        "real_name": "{} {}".format(
+            "".join(random.choices(string.ascii_lowercase, k=6)).title(),
+            "".join(random.choices(string.ascii_lowercase, k=9)).title(),
+        ),
+        "is_group": random.random() < 0.1,
+        "calnet_uid": random.randrange(10**6, 10**7),
+        "callink_oid": None,
+        "email": f"{user_name}@berkeley.edu",
+        "encrypted_password": random.randbytes(256),
+        "reason": str(["Username is similar to an existing account"]),
+    }
+
+
+def task_body(*args):
+    """The body of a task message, in Celery's message protocol 2."""
+    return (args, {}, {"callbacks": None, "errbacks": None, "chain": None, "chord": None})
+
+
+def measure(serializer, payload, number):
+    content_type, encoding, data = dumps(payload, serializer=serializer)
+    encode = timeit.timeit(lambda: dumps(payload, serializer=serializer), number=number)
+    decode = timeit.timeit(
+        lambda: loads(data, content_type, encoding, accept={content_type}),
+        number=number,
+    )
+    return len(data), encode / number * 1e6, decode / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=200, help="iterations per case")
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[0, 10, 100, 500],
+        help="pending request list sizes",
+    )
+    args = parser.parse_args()
+
+    random.seed(0)
+    cases = [
+        (serializer, "approve_request args", task_body("someuser"))
+        for serializer in SERIALIZERS
+    ]
+    for size in args.sizes:
+        rows = [fake_row(i) for i in range(size)]
+        name = f"{size} pending requests"
+        if StoredNewAccountRequest is not None:
+            cases.append(
+                ("pickle-orm", name, [StoredNewAccountRequest(**row) for row in rows]),
+            )
+        for row in rows:
+            del row["encrypted_password"]
+        cases.extend((serializer, name, rows) for serializer in SERIALIZERS)
+
+    print(
+        "{:<24} {:<10} {:>10} {:>12} {:>12}".format(
+            "case",
+            "format",
+            "bytes",
+            "encode (us)",
+            "decode (us)",
+        ),
+    )
+    for serializer, name, payload in cases:
+        try:
+            size, encode, decode = measure(
+                serializer.split("-")[0],
+                payload,
+                args.number,
+            )
+        except Exception as ex:
+            print(f"{name:<24} {serializer:<10} unavailable: {ex}")
+        else:
+            print(f"{name:<24} {serializer:<10} {size:>10} {encode:>12.1f} {decode:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
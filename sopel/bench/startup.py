@@ -0,0 +1,184 @@
+"""Check that the plugins load within their startup budget.
+
+Sopel loads and sets up every plugin before it connects, so anything slow
+there keeps a restarted bot out of its channels. This imports each plugin
+file in a fresh interpreter, with Sopel already imported as it is in the
+bot, and fails if the import takes longer than the budget or pulls in one
+of the slow dependencies the plugins only import on first use. Then it runs
+each plugin's setup() against the fakes in fakes.py, and checks that too.
+Run it with the same Python environment as the bot, which needs the real
+dependencies installed:
+
+    python sopel/bench/startup.py
+    python sopel/bench/startup.py --import-budget 0.02 --repeat 5
+
+It exits with status 1 if any plugin is over budget. CI runs it on every
+push and pull request (.github/workflows/startup.yml), so a change that
+slows down startup fails there. The bot itself reports the same split at
+boot, and in !stats startup.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from fakes import Dataset
+from fakes import FakeBot
+from fakes import FakeServices
+from fakes import FakeSettings
+from fakes import FakeWorker
+from handlers import LIB_DIR
+from handlers import load_plugins
+from handlers import PLUGINS
+from handlers import PLUGINS_DIR
+
+
+# seconds each plugin may take to import, and to run setup()
+IMPORT_BUDGET = 0.05
+SETUP_BUDGET = 0.05
+
+# top-level packages the plugins only import on first use
+DEFERRED = ("celery", "kombu", "ldap3", "ocflib")
+
+# imports a plugin file like Sopel's PyFilePlugin does, and prints how long
+# that took and which modules it imported
+IMPORT_PLUGIN = """
+import importlib.util
+import json
+import sys
+import time
+
+import sopel.config
+import sopel.plugin
+import sopel.tools
+
+name, path = sys.argv[1:]
+before = set(sys.modules)
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location(name, path)
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+print(
+    json.dumps(
+        {
+            "seconds": time.perf_counter() - started,
+            "modules": sorted(set(sys.modules) - before),
+        },
+    ),
+)
+"""
+
+
+def plugin_names():
+    """Return the name of every plugin, in the order handlers.py sets them up."""
+    names = [
+        os.path.splitext(filename)[0]
+        for filename in sorted(os.listdir(PLUGINS_DIR))
+        if filename.endswith(".py")
+    ]
+    return [name for name in PLUGINS if name in names] + [
+        name for name in names if name not in PLUGINS
+    ]
+
+
+def time_import(name, repeat):
+    """Import a plugin in repeat fresh interpreters.
+
+    Returns the fastest import time, and the deferred packages it imported.
+    """
+    path = os.path.join(PLUGINS_DIR, f"{name}.py")
+    times = []
+    for _ in range(repeat):
+        result = json.loads(
+            subprocess.run(
+                [sys.executable, "-c", IMPORT_PLUGIN, name, path],
+                env={**os.environ, "PYTHONPATH": LIB_DIR},
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout,
+        )
+        times.append(result["seconds"])
+    packages = {module.split(".")[0] for module in result["modules"]}
+    return min(times), sorted(packages & set(DEFERRED))
+
+
+def time_setup(names):
+    """Set up the plugins against the fakes, returning each one's setup() time."""
+    services = FakeServices(Dataset(users=1000, groups=100, sessions=20))
+    plugins = load_plugins(services, names)
+    bot = FakeBot(
+        FakeSettings(
+            tempfile.mkdtemp(prefix="ocfbench-"),
+            {"celery": {"broker": "memory://", "backend": "cache+memory://"}},
+        ),
+    )
+
+    seconds = {}
+    for name in names:
+        if hasattr(plugins[name], "setup"):
+            started = time.perf_counter()
+            plugins[name].setup(bot)
+            seconds[name] = time.perf_counter() - started
+
+    # let the create plugin's listener finish loading the pending requests,
+    # so that it stops promptly
+    worker = None
+    if "create" in plugins:
+        worker = FakeWorker(plugins["create"].celery_app(bot))
+        worker.start()
+    for name in reversed(names):
+        if hasattr(plugins[name], "shutdown"):
+            plugins[name].shutdown(bot)
+    if worker is not None:
+        worker.stop()
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--import-budget",
+        type=float,
+        default=IMPORT_BUDGET,
+        help=f"seconds each plugin may take to import (default: {IMPORT_BUDGET})",
+    )
+    parser.add_argument(
+        "--setup-budget",
+        type=float,
+        default=SETUP_BUDGET,
+        help=f"seconds each plugin's setup() may take (default: {SETUP_BUDGET})",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="imports per plugin, the fastest counts")
+    args = parser.parse_args()
+
+    names = plugin_names()
+    imports = {name: time_import(name, args.repeat) for name in names}
+    setups = time_setup(names)
+
+    failures = []
+    print("{:<12} {:>12} {:>11}".format("plugin", "import (ms)", "setup (ms)"))
+    for name in names:
+        imported, deferred = imports[name]
+        set_up = setups.get(name, 0)
+        print(f"{name:<12} {imported * 1e3:>12.1f} {set_up * 1e3:>11.1f}")
+        if imported > args.import_budget:
+            failures.append(f"{name} took {imported * 1e3:.0f}ms to import")
+        if deferred:
+            failures.append("{} imports {} when it loads".format(name, ", ".join(deferred)))
+        if set_up > args.setup_budget:
+            failures.append(f"{name} took {set_up * 1e3:.0f}ms to set up")
+
+    if failures:
+        print()
+        for failure in failures:
+            print(f"over budget: {failure}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Helpers shared by the OCF plugins.
+
+Sopel loads each file in its plugins directory as a plugin of its own, and
+the plugins can't import each other, so what they have in common lives
+here instead. This module is mounted from the sopel-lib ConfigMap onto the
+bot's PYTHONPATH, not into the plugins directory, so Sopel doesn't load it
+as a plugin; unlike the plugins, it isn't reloaded when it changes.
+
+The plugins import ocflib, ldap3, celery and kombu where they use them
+rather than at the top, since each takes a good part of a second to import
+and Sopel loads every plugin before it connects. How long each plugin took
+to import and set up is recorded here, for the ocf plugin to report.
+"""
+
+import functools
+import time
+from types import SimpleNamespace
+
+
+# the ocf plugin times the commands and runs their blocking backend calls on
+# its threads, through the CommandRunner it shares in bot.memory; without it,
+# both just run directly
+DIRECT = SimpleNamespace(
+    run=lambda func, bot, trigger: func(bot, trigger),
+    call=lambda name, func, *args, **kwargs: func(*args, **kwargs),
+)
+
+
+def runner(bot):
+    """Return the ocf plugin's CommandRunner, or DIRECT if it isn't loaded."""
+    return bot.memory.get("ocf_runner", DIRECT)
+
+
+def profiled(func):
+    """Run a command through the CommandRunner, so that it's timed."""
+
+    @functools.wraps(func)
+    def wrapper(bot, trigger):
+        return runner(bot).run(func, bot, trigger)
+
+    return wrapper
+
+
+def state_outdated(bot, name, version):
+    """Return whether a plugin has to replace the state it keeps in bot.memory.
+
+    Plugins keep their caches, connections and so on in bot.memory, so that
+    they carry over when the plugin is reloaded. Each plugin has a
+    STATE_VERSION, bumped when the classes kept there change; the state is
+    replaced when the plugin is first loaded, and when it was made by a
+    version with other classes. Call state_replaced() once it has been.
+    """
+    return bot.memory.get(f"{name}_state") != version
+
+
+def state_replaced(bot, name, version):
+    bot.memory[f"{name}_state"] = version
+
+
+def reloading(bot, name):
+    """Return whether a plugin is being reloaded, rather than unloaded for good.
+
+    The autoreload plugin lists the plugins it is reloading in
+    bot.memory["reloading"]. Their shutdown() keeps what the next version
+    picks up from bot.memory.
+    """
+    return name in bot.memory.get("reloading", ())
+
+
+# plugin name -> time.perf_counter() its module started running, until its
+# setup() is called
+_importing = {}
+# plugin name -> (seconds importing, seconds in setup()), when the bot
+# started, in the order the plugins were set up
+_load_times = {}
+
+
+def plugin_importing(name):
+    """Note that a plugin's module has started running.
+
+    Plugins call this right after their imports, which are cheap since the
+    slow ones are deferred, so the import time is mostly the module's body.
+    """
+    _importing[name] = time.perf_counter()
+
+
+def timed_setup(setup):
+    """Decorate a plugin's setup() to record how long the plugin took to load.
+
+    The import time runs from plugin_importing() to setup() being called,
+    which Sopel does right after importing the plugin. Only the first load
+    is recorded, since that's the one the bot waits for before connecting.
+    """
+
+    @functools.wraps(setup)
+    def wrapper(bot):
+        started = time.perf_counter()
+        try:
+            return setup(bot)
+        finally:
+            name = setup.__module__
+            imported = _importing.pop(name, None)
+            if imported is not None and name not in _load_times:
+                _load_times[name] = (started - imported, time.perf_counter() - started)
+
+    return wrapper
+
+
+def load_times():
+    """Return (name, import seconds, setup() seconds) for each plugin loaded at startup."""
+    return [(name, *times) for name, times in _load_times.items()]
@@ -0,0 +1,176 @@
+"""Reload plugins when their files change, without restarting the bot.
+
+The plugins are mounted from the sopel-plugins ConfigMap, which Kubernetes
+updates in place when it changes. Each plugin is responsible for stopping
+its threads in shutdown() and for picking up its state from bot.memory in
+setup(). If the new version of a plugin fails to load or set up, the old
+version is put back.
+"""
+
+import hashlib
+import os
+import sys
+import time
+
+from ocfplugins import plugin_importing
+from ocfplugins import timed_setup
+from sopel import plugin
+from sopel.plugins import handlers
+from sopel.tools import get_logger
+
+
+plugin_importing(__name__)
+
+LOGGER = get_logger("autoreload")
+
+# how often (in seconds) the plugin files are checked for changes
+RELOAD_POLL_INTERVAL = 10
+
+PLUGINS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _read(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        # the ConfigMap is being swapped out under us, try again later
+        return None
+
+
+def _plugin_files():
+    """Yield the name and path of each plugin file, except this one."""
+    for filename in sorted(os.listdir(PLUGINS_DIR)):
+        name, ext = os.path.splitext(filename)
+        path = os.path.join(PLUGINS_DIR, filename)
+        # this plugin's own job would be unregistered while it runs
+        if ext == ".py" and path != os.path.abspath(__file__):
+            yield name, path
+
+
+@timed_setup
+def setup(bot):
+    # name -> digest of the file the loaded version of the plugin came from;
+    # the plugins are all loaded at startup, from the files as they are now
+    bot.memory["autoreload_digests"] = {}
+    for name, path in _plugin_files():
+        source = _read(path)
+        if source is not None:
+            bot.memory["autoreload_digests"][name] = hashlib.sha256(source).hexdigest()
+    # name -> (time of the last reload, seconds it took, error or None)
+    bot.memory["autoreload_history"] = {}
+    bot.memory.setdefault("stats", {})["autoreload"] = stats
+
+
+def stats(bot):
+    """Return when each plugin was last reloaded, for !stats."""
+    history = bot.memory["autoreload_history"]
+    lines = []
+    for name, (reloaded_at, seconds, error) in sorted(history.items()):
+        lines.append(
+            "{name}: {result} {ago:.0f}s ago{took}".format(
+                name=name,
+                result="reloaded" if error is None else f"failed to reload ({error})",
+                ago=time.time() - reloaded_at,
+                took=f" in {seconds:.2f}s" if error is None else "",
+            ),
+        )
+    return lines or ["no plugins reloaded yet"]
+
+
+class PreviousVersion(handlers.PyFilePlugin):
+    """A plugin file's version from before a failed reload.
+
+    Loading it puts back the module kept from before the reload, instead of
+    running the file again; reloading it later runs the file, like for any
+    other plugin file.
+    """
+
+    def __init__(self, path, module):
+        super().__init__(path)
+        self.previous = module
+
+    def load(self):
+        # Sopel keeps the modules of plugin files in sys.modules, where
+        # PyModulePlugin.load() imports them from by name
+        sys.modules[self.name] = self.previous
+        handlers.PyModulePlugin.load(self)
+
+
+def _restore(bot, name, path, module):
+    """Put the old version of a plugin back after its new version failed to load."""
+    if bot.has_plugin(name):
+        # the old version's shutdown() failed, so it was never unregistered
+        return
+
+    # the new version may have started threads in setup() before failing
+    new = sys.modules.get(name)
+    if new is not module and hasattr(new, "shutdown"):
+        try:
+            new.shutdown(bot)
+        except Exception:
+            LOGGER.exception("Failed to shut down the new version of %s", name)
+
+    handler = PreviousVersion(path, module)
+    handler.load()
+    handler.setup(bot)
+    handler.register(bot)
+
+
+def reload(bot, name, path):
+    """Reload a plugin, letting it know that it isn't being unloaded for good."""
+    reloading = bot.memory.setdefault("reloading", set())
+    reloading.add(name)
+    # kept to put back if the new version fails
+    module = sys.modules.get(name)
+    started = time.monotonic()
+    try:
+        bot.reload_plugin(name)
+    except Exception as ex:
+        bot.memory["autoreload_history"][name] = (time.time(), None, ex)
+        if module is None:
+            LOGGER.exception(
+                "Failed to reload %s, and its old version isn't in sys.modules to go back to; it is unloaded",
+                name,
+            )
+            return
+        # Sopel has shut the old version down and unregistered it by the time
+        # the new one is imported and set up
+        LOGGER.exception("Failed to reload %s, going back to the old version", name)
+        try:
+            _restore(bot, name, path, module)
+        except Exception:
+            LOGGER.exception("Failed to restore the old version of %s, it is unloaded", name)
+    else:
+        seconds = time.monotonic() - started
+        LOGGER.info("Reloaded %s in %.2fs", name, seconds)
+        bot.memory["autoreload_history"][name] = (time.time(), seconds, None)
+    finally:
+        reloading.discard(name)
+
+
+@plugin.interval(RELOAD_POLL_INTERVAL)
+def watch(bot):
+    """Reload the plugins whose files changed since they were loaded."""
+    digests = bot.memory["autoreload_digests"]
+    for name, path in _plugin_files():
+        source = _read(path)
+        if source is None or not bot.has_plugin(name):
+            continue
+
+        digest = hashlib.sha256(source).hexdigest()
+        previous = digests.get(name)
+        digests[name] = digest
+        if previous is None or previous == digest:
+            continue
+
+        # don't bother taking a working plugin down for one that won't even
+        # compile; other errors are caught when reloading
+        try:
+            compile(source, path, "exec")
+        except SyntaxError as ex:
+            LOGGER.error("Not reloading %s, it doesn't compile: %s", name, ex)
+            bot.memory["autoreload_history"][name] = (time.time(), None, ex)
+            continue
+
+        reload(bot, name, path)
@@ -1,13 +1,106 @@
 """Show information about OCF users."""
 
+import base64
+import functools
 import grp
+import json
+import os
+import sqlite3
 import string
+import threading
+import time
+from collections import defaultdict
+from collections import OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager
+from datetime import datetime
+from datetime import timezone
 
-from ocflib.account import search
-from ocflib.infra import ldap
+from ocfplugins import plugin_importing
+from ocfplugins import profiled
+from ocfplugins import reloading
+from ocfplugins import runner
+from ocfplugins import state_outdated
+from ocfplugins import state_replaced
+from ocfplugins import timed_setup
 from sopel import plugin
+from sopel.tools import get_logger
 
 
+plugin_importing(__name__)
+
+LOGGER = get_logger("check")
+
+# how often (in seconds) the group membership index is rebuilt from NSS
+GROUP_INDEX_TTL = 300
+
+# bounds for the cache of LDAP user attributes; nonexistent users are cached
+# for less time so that new accounts show up quickly
+ATTR_CACHE_SIZE = 512
+ATTR_CACHE_TTL = 300
+ATTR_CACHE_NEGATIVE_TTL = 60
+
+# the LDAP pool holds at most this many connections (and concurrent searches),
+# and closes connections idle for longer than the server is likely to keep them
+LDAP_POOL_SIZE = 4
+LDAP_POOL_IDLE_TIMEOUT = 240
+LDAP_CONNECT_ATTEMPTS = 3
+LDAP_CONNECT_BACKOFF = 0.5
+
+# the account search index picks up changed entries every SYNC seconds, and is
+# rebuilt from scratch every REBUILD seconds to drop deleted accounts
+SEARCH_INDEX_SYNC = 300
+SEARCH_INDEX_REBUILD = 6 * 60 * 60
+SEARCH_INDEX_PAGE_SIZE = 1000
+
+# checkacct replies with a page of results at a time, and remembers the rest
+# for !more; LDAP fallback searches are capped at CHECKACCT_MAX_RESULTS, and
+# at most CHECKACCT_MAX_CURSORS nicks' results are remembered
+CHECKACCT_PAGE_SIZE = 5
+CHECKACCT_MAX_RESULTS = 100
+CHECKACCT_CURSOR_TTL = 300
+CHECKACCT_MAX_CURSORS = 100
+
+# the caches are saved to a SQLite database in the bot's home directory (the
+# sopel-data volume), so that a restarted bot starts with them warm; indexes
+# saved more than CACHE_STORE_MAX_AGE seconds ago aren't loaded, and the attr
+# cache is saved every CACHE_STORE_SAVE_INTERVAL seconds if it changed
+CACHE_STORE_FILE = "check-cache.sqlite3"
+CACHE_STORE_MAX_AGE = 24 * 60 * 60
+CACHE_STORE_SAVE_INTERVAL = 60
+# bump when the tables below change; the database is then emptied and
+# recreated, since everything in it can be fetched again
+CACHE_STORE_SCHEMA = 1
+CACHE_STORE_TABLES = """
+CREATE TABLE meta (
+    name TEXT PRIMARY KEY,
+    built_at REAL NOT NULL,
+    saved_at REAL NOT NULL,
+    ttl REAL NOT NULL,
+    extra TEXT
+);
+CREATE TABLE user_attrs (
+    uid TEXT PRIMARY KEY,
+    expires_at REAL NOT NULL,
+    attrs TEXT
+);
+CREATE TABLE group_names (
+    gid INTEGER PRIMARY KEY,
+    name TEXT NOT NULL
+);
+CREATE TABLE group_members (
+    uid TEXT PRIMARY KEY,
+    groups TEXT NOT NULL
+);
+CREATE TABLE accounts (
+    uid TEXT PRIMARY KEY,
+    cn TEXT NOT NULL
+);
+"""
+
+# see ocfplugins.state_outdated()
+STATE_VERSION = 2
+
 GROUP_COLOR_MAPPING = {
     "ocf": "\x0314",  # gray
     "sorry": "\x0304",  # red
@@ -20,80 +113,1028 @@ GROUP_COLOR_MAPPING = {
 }
 
 
-@plugin.command("check")
-def check(bot, trigger):
-    """Print information about an OCF user."""
-    user = trigger.group(2).strip()
-    attrs = search.user_attrs(user)
+def _color_group(name):
+    return "{}{}\x0f".format(GROUP_COLOR_MAPPING.get(name, ""), name)
 
-    if attrs is not None:
-        groups = [grp.getgrgid(attrs["gidNumber"]).gr_name]
-        groups.extend(
-            sorted(group.gr_name for group in grp.getgrall() if user in group.gr_mem),
+
+def _tag(value):
+    """Turn the values in LDAP attributes that JSON lacks into tagged objects."""
+    if isinstance(value, datetime):
+        return {"$datetime": value.isoformat()}
+    elif isinstance(value, bytes):
+        return {"$bytes": base64.b64encode(value).decode()}
+    elif isinstance(value, Mapping):
+        # ldap3's CaseInsensitiveDict
+        return dict(value)
+    raise TypeError(f"can't save {type(value).__name__} in the cache store")
+
+
+def _untag(obj):
+    if len(obj) == 1:
+        if "$datetime" in obj:
+            return datetime.fromisoformat(obj["$datetime"])
+        elif "$bytes" in obj:
+            return base64.b64decode(obj["$bytes"])
+    return obj
+
+
+def _dump(value):
+    return json.dumps(value, default=_tag, separators=(",", ":"))
+
+
+def _load(text):
+    return json.loads(text, object_hook=_untag)
+
+
+class CacheStore:
+    """SQLite database the caches are saved to, so that they survive restarts.
+
+    It only ever holds copies: whatever is loaded from it gets revalidated
+    against LDAP and NSS in the background, and a database that can't be
+    read is deleted and started over. Each saved index has a row in the meta
+    table with when it was built and saved, and how long it may be used for.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+        # name -> age in seconds of what was loaded at startup
+        self.loaded = {}
+        self.saves = 0
+        self.errors = 0
+
+    def _open(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        # a crash may lose the last few saves, which is fine for a cache
+        db.execute("PRAGMA synchronous=NORMAL")
+        if db.execute("PRAGMA user_version").fetchone()[0] != CACHE_STORE_SCHEMA:
+            tables = db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+            with db:
+                for (table,) in tables.fetchall():
+                    db.execute(f'DROP TABLE "{table}"')
+                db.executescript(CACHE_STORE_TABLES)
+                db.execute(f"PRAGMA user_version = {CACHE_STORE_SCHEMA}")
+        return db
+
+    def _connect(self):
+        try:
+            return self._open()
+        except sqlite3.DatabaseError:
+            LOGGER.exception("Can't read the cache store %s, starting over", self.path)
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.remove(self.path + suffix)
+                except FileNotFoundError:
+                    pass
+            return self._open()
+
+    @contextmanager
+    def _transaction(self):
+        """Context manager that provides the database, in a transaction."""
+        with self._lock:
+            if self._db is None:
+                self._db = self._connect()
+            with self._db:
+                yield self._db
+
+    def _run(self, func, default=None):
+        """Call func with the database, logging rather than raising errors."""
+        try:
+            with self._transaction() as db:
+                return func(db)
+        except (sqlite3.Error, OSError, TypeError, ValueError):
+            self.errors += 1
+            LOGGER.exception("Cache store %s failed", self.path)
+            return default
+
+    def _meta(self, db, name):
+        """Return (built_at, saved_at, extra) of an index, if it isn't too old."""
+        row = db.execute(
+            "SELECT built_at, saved_at, ttl, extra FROM meta WHERE name = ?",
+            (name,),
+        ).fetchone()
+        if row is None or time.time() - row[1] > row[2]:
+            return None
+        built_at, saved_at, _, extra = row
+        self.loaded[name] = time.time() - saved_at
+        return built_at, saved_at, extra
+
+    def _save_meta(self, db, name, built_at, extra=None):
+        db.execute(
+            "INSERT OR REPLACE INTO meta VALUES (?, ?, ?, ?, ?)",
+            (name, built_at, time.time(), CACHE_STORE_MAX_AGE, extra),
+        )
+        self.saves += 1
+
+    def load_attrs(self):
+        """Return (uid, expires_at, attrs) of the saved attrs that haven't expired."""
+
+        def load(db):
+            rows = db.execute(
+                "SELECT uid, expires_at, attrs FROM user_attrs WHERE expires_at > ? ORDER BY expires_at",
+                (time.time(),),
+            )
+            return [
+                (uid, expires_at, _load(attrs) if attrs is not None else None)
+                for uid, expires_at, attrs in rows
+            ]
+
+        return self._run(load, [])
+
+    def save_attrs(self, entries):
+        """Replace the saved attrs with (uid, expires_at, attrs) entries."""
+        rows = []
+        for uid, expires_at, attrs in entries:
+            try:
+                rows.append((uid, expires_at, _dump(attrs) if attrs is not None else None))
+            except (TypeError, ValueError):
+                # one odd attribute isn't worth failing the whole save over
+                self.errors += 1
+
+        def save(db):
+            db.execute("DELETE FROM user_attrs")
+            db.executemany("INSERT INTO user_attrs VALUES (?, ?, ?)", rows)
+            self.saves += 1
+
+        self._run(save)
+
+    def load_groups(self):
+        """Return (built_at, gid -> name, uid -> groups) of the saved group index."""
+
+        def load(db):
+            meta = self._meta(db, "groups")
+            if meta is None:
+                return None
+            names = dict(db.execute("SELECT gid, name FROM group_names"))
+            members = {
+                uid: tuple(_load(groups))
+                for uid, groups in db.execute("SELECT uid, groups FROM group_members")
+            }
+            return meta[0], names, members
+
+        return self._run(load)
+
+    def save_groups(self, built_at, names, members):
+        def save(db):
+            db.execute("DELETE FROM group_names")
+            db.executemany("INSERT INTO group_names VALUES (?, ?)", names.items())
+            db.execute("DELETE FROM group_members")
+            db.executemany(
+                "INSERT INTO group_members VALUES (?, ?)",
+                ((uid, _dump(groups)) for uid, groups in members.items()),
+            )
+            self._save_meta(db, "groups", built_at)
+
+        self._run(save)
+
+    def load_accounts(self):
+        """Return (built_at, saved_at, last modified, uid -> cn) of the search index."""
+
+        def load(db):
+            meta = self._meta(db, "accounts")
+            if meta is None:
+                return None
+            built_at, saved_at, last_modified = meta
+            accounts = dict(db.execute("SELECT uid, cn FROM accounts"))
+            return built_at, saved_at, _load(last_modified), accounts
+
+        return self._run(load)
+
+    def save_accounts(self, built_at, last_modified, accounts, replace):
+        """Save uid -> cn of accounts, replacing the saved ones if replace is set."""
+
+        def save(db):
+            if replace:
+                db.execute("DELETE FROM accounts")
+            db.executemany("INSERT OR REPLACE INTO accounts VALUES (?, ?)", accounts.items())
+            self._save_meta(db, "accounts", built_at, _dump(last_modified))
+
+        self._run(save)
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def stats(self):
+        return "cache store: {saves} saves, {errors} errors, loaded {loaded} at startup".format(
+            saves=self.saves,
+            errors=self.errors,
+            loaded=", ".join(
+                f"{name} ({age:.0f}s old)" for name, age in sorted(self.loaded.items())
+            )
+            or "nothing",
+        )
+
+
+class GroupIndex:
+    """Inverted index of group membership, built from a single grp.getgrall().
+
+    With NSS backed by LDAP, enumerating every group is a full directory scan,
+    so it is done once per TTL in the background rather than once per lookup.
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+        self._refresh_lock = threading.Lock()
+        self._members = None
+        self._names = {}
+        self._colored = {}
+        self._built_at = None
+        # bumped on every build, so that anything derived from the index can
+        # tell whether it is out of date
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _build(self):
+        members = defaultdict(list)
+        names = {}
+        for group in grp.getgrall():
+            names[group.gr_gid] = group.gr_name
+            for member in group.gr_mem:
+                members[member].append(group.gr_name)
+
+        self._names = names
+        self._colored = {name: _color_group(name) for name in names.values()}
+        self._members = {
+            user: tuple(sorted(groups)) for user, groups in members.items()
+        }
+        self._built_at = time.monotonic()
+        self.version += 1
+        if self.store is not None:
+            self.store.save_groups(time.time(), self._names, self._members)
+
+    def refresh(self):
+        """Rebuild the index from the group database."""
+        with self._refresh_lock:
+            self._build()
+
+    def warm_start(self):
+        """Use the saved index until it has been rebuilt from the group database."""
+        saved = self.store.load_groups() if self.store is not None else None
+        if saved is not None:
+            built_at, names, members = saved
+            with self._refresh_lock:
+                if self._members is None:
+                    self._names = names
+                    self._colored = {name: _color_group(name) for name in names.values()}
+                    self._members = members
+                    self._built_at = time.monotonic() - (time.time() - built_at)
+                    self.version += 1
+        self.refresh()
+
+    def age(self):
+        """Return the age of the index in seconds, or None if it is not built."""
+        if self._built_at is None:
+            return None
+        return time.monotonic() - self._built_at
+
+    def group_name(self, gid):
+        """Return the name of the group with the given gid."""
+        name = self._names.get(gid)
+        if name is None:
+            name = grp.getgrgid(gid).gr_name
+        return name
+
+    def colored(self, name):
+        """Return the name of a group with its IRC color, if it has one."""
+        colored = self._colored.get(name)
+        if colored is None:
+            colored = _color_group(name)
+        return colored
+
+    def groups(self, user):
+        """Return the sorted names of the supplementary groups of a user."""
+        if self._members is None:
+            # only reached before the first build has finished
+            self.misses += 1
+            with self._refresh_lock:
+                if self._members is None:
+                    self._build()
+        else:
+            self.hits += 1
+        return self._members.get(user, ())
+
+    def stats(self):
+        age = self.age()
+        return "group index: {users} members, {hits} hits, {misses} misses, age {age}".format(
+            users=len(self._members or ()),
+            hits=self.hits,
+            misses=self.misses,
+            age=f"{age:.0f}s" if age is not None else "n/a",
+        )
+
+
+def _connection_errors():
+    """Return the exceptions that mean an LDAP connection is no good anymore."""
+    from ldap3.core.exceptions import LDAPCommunicationError
+    from ldap3.core.exceptions import LDAPResponseTimeoutError
+
+    # LDAPCommunicationError covers the socket errors and the server hanging up
+    return (LDAPCommunicationError, LDAPResponseTimeoutError, OSError)
+
+
+class LDAPPool:
+    """Pool of persistent, bound connections to the OCF LDAP server.
+
+    Opening a connection costs a TCP and TLS handshake plus a bind, which is
+    most of the time spent on a small search, so connections are kept around
+    between commands. Connections are health-checked when taken out of the
+    pool and thrown away as soon as talking to the server over them fails;
+    other errors, like a bad filter, leave the connection in the pool.
+    """
+
+    def __init__(self, size=LDAP_POOL_SIZE):
+        self.size = size
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = []
+        self.opened = 0
+        self.closed = 0
+
+    def _open(self):
+        from ldap3.core.exceptions import LDAPException
+        from ocflib.infra import ldap
+
+        for attempt in range(LDAP_CONNECT_ATTEMPTS):
+            # keep ocflib's context manager around so that closing the
+            # connection later goes through the same code path
+            context = ldap.ldap_ocf()
+            try:
+                conn = context.__enter__()
+            except LDAPException:
+                if attempt == LDAP_CONNECT_ATTEMPTS - 1:
+                    raise
+                time.sleep(LDAP_CONNECT_BACKOFF * 2**attempt)
+            else:
+                self.opened += 1
+                return context, conn
+
+    def _close(self, context):
+        from ldap3.core.exceptions import LDAPException
+
+        self.closed += 1
+        try:
+            context.__exit__(None, None, None)
+        except LDAPException:
+            pass
+
+    def _take(self):
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                entry = self._idle.pop() if self._idle else None
+            if entry is None:
+                return self._open()
+            context, conn, last_used = entry
+            if conn.bound and not conn.closed and now - last_used < LDAP_POOL_IDLE_TIMEOUT:
+                return context, conn
+            self._close(context)
+
+    def _discard_idle(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for context, _, _ in idle:
+            self._close(context)
+
+    @contextmanager
+    def connection(self):
+        """Context manager that provides a pooled ldap3 Connection.
+
+        This has the same interface as ldap.ldap_ocf, so it can be passed as
+        the connection argument of the ocflib search functions.
+        """
+        with self._slots:
+            context, conn = self._take()
+            try:
+                yield conn
+            except _connection_errors():
+                # if one connection died, the idle ones probably did too
+                self._close(context)
+                self._discard_idle()
+                raise
+            except BaseException:
+                self._release(context, conn)
+                raise
+            self._release(context, conn)
+
+    def _release(self, context, conn):
+        with self._lock:
+            self._idle.append((context, conn, time.monotonic()))
+
+    def retry(self, func, *args, **kwargs):
+        """Call func, retrying once if it failed on a stale pooled connection."""
+        try:
+            return func(*args, **kwargs)
+        except _connection_errors():
+            return func(*args, **kwargs)
+
+    def search(self, *args, **kwargs):
+        """Run a search on a pooled connection and return the response entries."""
+
+        def run():
+            with self.connection() as c:
+                c.search(*args, **kwargs)
+                return list(c.response or ())
+
+        return self.retry(run)
+
+    def paged_search(self, *args, **kwargs):
+        """Like search, but fetch every result using the paged results control."""
+
+        def run():
+            with self.connection() as c:
+                return list(
+                    c.extend.standard.paged_search(*args, generator=True, **kwargs),
+                )
+
+        return self.retry(run)
+
+    def stats(self):
+        return "ldap pool: {idle}/{size} idle, {opened} opened, {closed} closed".format(
+            idle=len(self._idle),
+            size=self.size,
+            opened=self.opened,
+            closed=self.closed,
+        )
+
+
+class AttrCache:
+    """LRU cache of search.user_attrs results with a per-entry TTL.
+
+    Staff tend to check the same few accounts over and over, so this keeps
+    repeated lookups off of LDAP. Misses (users that don't exist) are cached
+    too, with their own shorter TTL.
+    """
+
+    def __init__(
+        self,
+        pool,
+        size=ATTR_CACHE_SIZE,
+        ttl=ATTR_CACHE_TTL,
+        negative_ttl=ATTR_CACHE_NEGATIVE_TTL,
+        store=None,
+    ):
+        self.pool = pool
+        self.store = store
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # whether there are entries the store doesn't have yet
+        self._dirty = False
+
+    def get(self, user, fresh=False, call=None):
+        """Return the LDAP attributes of a user, or None if they don't exist.
+
+        If fresh is set, the cache is bypassed (but still updated). On a miss,
+        the lookup is made by call(func), e.g. on the ocf plugin's backend
+        threads, or directly if call isn't set.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user)
+            if not fresh and entry is not None and entry[0] > now:
+                self._entries.move_to_end(user)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        from ocflib.account import search
+
+        fetch = functools.partial(
+            self.pool.retry,
+            search.user_attrs,
+            user,
+            connection=self.pool.connection,
         )
-        groups = [
-            "{}{}\x0f".format(GROUP_COLOR_MAPPING.get(group, ""), group)
-            for group in groups
-        ]
+        attrs = fetch() if call is None else call(fetch)
+        ttl = self.ttl if attrs is not None else self.negative_ttl
 
-        if "creationTime" in attrs:
-            created = attrs["creationTime"].strftime("%Y-%m-%d")
+        with self._lock:
+            self._entries[user] = (now + ttl, attrs)
+            self._entries.move_to_end(user)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._dirty = True
+
+        return attrs
+
+    def load(self):
+        """Add the saved entries that haven't expired yet to the cache."""
+        if self.store is None:
+            return
+        entries = self.store.load_attrs()
+        now, wall = time.monotonic(), time.time()
+        with self._lock:
+            for user, expires_at, attrs in entries:
+                # anything fetched since startup is newer
+                if user not in self._entries:
+                    self._entries[user] = (now + expires_at - wall, attrs)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def save(self):
+        """Save the entries that haven't expired, if they changed since the last save."""
+        if self.store is None or not self._dirty:
+            return
+        now, wall = time.monotonic(), time.time()
+        with self._lock:
+            self._dirty = False
+            entries = [
+                (user, wall + expires - now, attrs)
+                for user, (expires, attrs) in self._entries.items()
+                if expires > now
+            ]
+        self.store.save_attrs(entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return "attr cache: {entries}/{size} entries, {ratio:.0%} hit ratio ({hits}/{lookups}), {evictions} evictions".format(
+            entries=len(self._entries),
+            size=self.size,
+            ratio=self.hits / lookups if lookups else 0,
+            hits=self.hits,
+            lookups=lookups,
+            evictions=self.evictions,
+        )
+
+
+class ReplyCache:
+    """Rendered !check replies, by user.
+
+    A reply is reused as long as it was rendered from the same attributes
+    (the attr cache returns a new dict whenever it refetches a user) and the
+    same version of the group index.
+    """
+
+    def __init__(self, size=ATTR_CACHE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user, attrs, version, render):
+        """Return the reply for a user, calling render if it is out of date."""
+        with self._lock:
+            entry = self._entries.get(user)
+            if entry is not None and entry[0] is attrs and entry[1] == version:
+                self._entries.move_to_end(user)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        reply = render()
+
+        with self._lock:
+            self._entries[user] = (attrs, version, reply)
+            self._entries.move_to_end(user)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+        return reply
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return "reply cache: {entries}/{size} entries, {ratio:.0%} hit ratio ({hits}/{lookups})".format(
+            entries=len(self._entries),
+            size=self.size,
+            ratio=self.hits / lookups if lookups else 0,
+            hits=self.hits,
+            lookups=lookups,
+        )
+
+
+def _trigrams(text):
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+def _rank(keywords, uid, cn):
+    """Score how well an account matches keywords, lower is better.
+
+    Each keyword scores by where it matches: exact uid, then uid prefix, then
+    uid substring, then cn. Returns None if some keyword doesn't match at all.
+    """
+    rank = 0
+    for keyword in keywords:
+        if uid == keyword:
+            continue
+        elif uid.startswith(keyword):
+            rank += 1
+        elif keyword in uid:
+            rank += 2
+        elif keyword in cn:
+            rank += 3
         else:
-            created = "unknown"
-
-        bot.say(
-            "{user} ({uid}) | {name} | created {created} | groups: {groups}".format(
-                user=user,
-                uid=attrs["uidNumber"],
-                name=attrs["cn"][0],
-                created=created,
-                groups=", ".join(groups),
-            ),
+            return None
+    return rank
+
+
+class AccountIndex:
+    """In-memory trigram index of the uid and cn of every account.
+
+    LDAP can't use an index for the leading-wildcard filters checkacct needs,
+    so every search is a scan of the People OU on the server. Instead, the
+    whole OU is loaded once and kept up to date by periodically fetching
+    entries whose modifyTimestamp changed since the last sync.
+    """
+
+    def __init__(self, pool, store=None):
+        self.pool = pool
+        self.store = store
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._entries = {}
+        self._trigrams = defaultdict(set)
+        self._synced_at = None
+        self._last_modified = None
+        # when (as a time.time()) the index was last loaded in full from LDAP
+        self._rebuilt_at = None
+        self.ready = False
+
+    def _fetch(self, search_filter):
+        from ocflib.infra import ldap
+
+        return self.pool.paged_search(
+            ldap.OCF_LDAP_PEOPLE,
+            search_filter,
+            attributes=("uid", "cn", "modifyTimestamp"),
+            paged_size=SEARCH_INDEX_PAGE_SIZE,
+        )
+
+    def _add(self, entries, trigrams, entry):
+        """Index an LDAP entry, returning its uid, or None if it was skipped."""
+        attrs = entry["attributes"]
+        if not attrs.get("uid") or not attrs.get("cn"):
+            return None
+        uid = attrs["uid"][0]
+        self._remove(entries, trigrams, uid)
+        self._insert(entries, trigrams, uid, attrs["cn"][0])
+
+        modified = attrs.get("modifyTimestamp")
+        if modified and (self._last_modified is None or modified > self._last_modified):
+            self._last_modified = modified
+        return uid
+
+    def _insert(self, entries, trigrams, uid, cn):
+        entries[uid] = (cn, uid.lower(), cn.lower())
+        for trigram in _trigrams(uid.lower()) | _trigrams(cn.lower()):
+            trigrams[trigram].add(uid)
+
+    def _remove(self, entries, trigrams, uid):
+        old = entries.pop(uid, None)
+        if old is not None:
+            for trigram in _trigrams(old[1]) | _trigrams(old[2]):
+                uids = trigrams.get(trigram)
+                if uids is not None:
+                    uids.discard(uid)
+                    if not uids:
+                        del trigrams[trigram]
+
+    def _rebuild(self):
+        entries = {}
+        trigrams = defaultdict(set)
+        self._last_modified = None
+        for entry in self._fetch("(uid=*)"):
+            self._add(entries, trigrams, entry)
+
+        with self._lock:
+            self._entries = entries
+            self._trigrams = trigrams
+            self._synced_at = time.monotonic()
+        self._rebuilt_at = time.time()
+        self.ready = True
+
+        if self.store is not None:
+            self.store.save_accounts(
+                self._rebuilt_at,
+                self._last_modified,
+                {uid: entry[0] for uid, entry in entries.items()},
+                replace=True,
+            )
+
+    def rebuild(self):
+        """Load every account from LDAP, replacing the current index."""
+        with self._sync_lock:
+            self._rebuild()
+
+    def _sync(self):
+        if not self.ready or self._last_modified is None:
+            self._rebuild()
+            return
+
+        since = self._last_modified.astimezone(timezone.utc)
+        changed = self._fetch(
+            "(&(uid=*)(modifyTimestamp>={}))".format(since.strftime("%Y%m%d%H%M%SZ")),
+        )
+        updated = {}
+        with self._lock:
+            for entry in changed:
+                uid = self._add(self._entries, self._trigrams, entry)
+                if uid is not None:
+                    updated[uid] = self._entries[uid][0]
+            self._synced_at = time.monotonic()
+
+        if self.store is not None:
+            self.store.save_accounts(self._rebuilt_at, self._last_modified, updated, replace=False)
+
+    def sync(self):
+        """Update the index with the accounts modified since the last sync."""
+        with self._sync_lock:
+            self._sync()
+
+    def warm_start(self):
+        """Load the saved index, then catch up on the changes since it was saved.
+
+        The saved index is searched in the meantime. If it was last rebuilt
+        longer than a rebuild interval ago, it may have accounts that were
+        deleted since, so it's rebuilt instead.
+        """
+        with self._sync_lock:
+            saved = self.store.load_accounts() if self.store is not None else None
+            if saved is None:
+                self._rebuild()
+                return
+
+            rebuilt_at, saved_at, last_modified, accounts = saved
+            entries = {}
+            trigrams = defaultdict(set)
+            for uid, cn in accounts.items():
+                self._insert(entries, trigrams, uid, cn)
+            with self._lock:
+                self._entries = entries
+                self._trigrams = trigrams
+                self._synced_at = time.monotonic() - (time.time() - saved_at)
+            self._last_modified = last_modified
+            self._rebuilt_at = rebuilt_at
+            self.ready = True
+
+            if time.time() - rebuilt_at > SEARCH_INDEX_REBUILD:
+                self._rebuild()
+            else:
+                self._sync()
+
+    def search(self, keywords):
+        """Return (uid, cn) for accounts matching every keyword, best first.
+
+        Keywords are matched as substrings of the uid or cn, like checkacct's
+        LDAP filter.
+        """
+        keywords = [keyword for keyword in keywords if keyword]
+        if not keywords:
+            return []
+
+        with self._lock:
+            candidates = None
+            for keyword in keywords:
+                if len(keyword) < 3:
+                    continue
+                for trigram in _trigrams(keyword):
+                    found = self._trigrams.get(trigram, set())
+                    candidates = found if candidates is None else candidates & found
+            if candidates is None:
+                candidates = self._entries.keys()
+
+            results = []
+            for uid in candidates:
+                cn, uid_lower, cn_lower = self._entries[uid]
+                rank = _rank(keywords, uid_lower, cn_lower)
+                if rank is not None:
+                    results.append((rank, uid, cn))
+
+        return [(uid, cn) for _, uid, cn in sorted(results)]
+
+    def stats(self):
+        age = time.monotonic() - self._synced_at if self._synced_at else None
+        return "search index: {entries} accounts, {trigrams} trigrams, synced {age}".format(
+            entries=len(self._entries),
+            trigrams=len(self._trigrams),
+            age=f"{age:.0f}s ago" if age is not None else "never",
         )
+
+
+@timed_setup
+def setup(bot):
+    # when the plugin is reloaded, the caches and connections of the previous
+    # version are kept, unless their classes changed
+    if state_outdated(bot, "check", STATE_VERSION):
+        previous = bot.memory.get("check_ldap")
+        if previous is not None:
+            previous._discard_idle()
+
+        previous = bot.memory.get("check_store")
+        if previous is not None:
+            previous.close()
+
+        store = CacheStore(os.path.join(bot.settings.core.homedir, CACHE_STORE_FILE))
+        bot.memory["check_store"] = store
+        bot.memory["check_ldap"] = LDAPPool()
+        bot.memory["check_attrs"] = AttrCache(bot.memory["check_ldap"], store=store)
+        bot.memory["check_groups"] = GroupIndex(store)
+        bot.memory["check_replies"] = ReplyCache()
+        bot.memory["check_accounts"] = AccountIndex(bot.memory["check_ldap"], store)
+        bot.memory["check_cursors"] = {}
+        state_replaced(bot, "check", STATE_VERSION)
+        # each of these loads what was saved before the restart, if anything,
+        # then brings it up to date
+        threading.Thread(target=bot.memory["check_attrs"].load, daemon=True).start()
+        threading.Thread(target=bot.memory["check_groups"].warm_start, daemon=True).start()
+        threading.Thread(target=bot.memory["check_accounts"].warm_start, daemon=True).start()
+
+    bot.memory.setdefault("stats", {})["check"] = stats
+
+
+def shutdown(bot):
+    bot.memory["check_attrs"].save()
+    # the next version keeps using the store
+    if not reloading(bot, "check"):
+        bot.memory["check_store"].close()
+
+
+@plugin.interval(CACHE_STORE_SAVE_INTERVAL)
+def save_attrs(bot):
+    """Periodically save the attr cache, for the next time the bot starts."""
+    bot.memory["check_attrs"].save()
+
+
+@plugin.interval(GROUP_INDEX_TTL)
+def refresh_groups(bot):
+    """Periodically rebuild the group membership index."""
+    bot.memory["check_groups"].refresh()
+
+
+@plugin.interval(SEARCH_INDEX_SYNC)
+def sync_accounts(bot):
+    """Periodically pick up modified accounts in the search index."""
+    bot.memory["check_accounts"].sync()
+
+
+@plugin.interval(SEARCH_INDEX_REBUILD)
+def rebuild_accounts(bot):
+    """Periodically rebuild the search index, dropping deleted accounts."""
+    bot.memory["check_accounts"].rebuild()
+
+
+def stats(bot):
+    """Return statistics about the check plugin's caches, for !stats."""
+    return [
+        bot.memory["check_attrs"].stats(),
+        bot.memory["check_replies"].stats(),
+        bot.memory["check_groups"].stats(),
+        bot.memory["check_accounts"].stats(),
+        bot.memory["check_ldap"].stats(),
+        bot.memory["check_store"].stats(),
+    ]
+
+
+@plugin.command("check")
+@profiled
+def check(bot, trigger):
+    """Print information about an OCF user; pass --fresh to skip the cache."""
+    args = (trigger.group(2) or "").split()
+    fresh = "--fresh" in args
+    user = " ".join(arg for arg in args if arg != "--fresh")
+    if not user:
+        bot.reply("usage: !check [--fresh] <user>")
+        return
+
+    attrs = bot.memory["check_attrs"].get(
+        user,
+        fresh=fresh,
+        call=functools.partial(runner(bot).call, "ldap"),
+    )
+
+    if attrs is not None:
+        index = bot.memory["check_groups"]
+        reply = bot.memory["check_replies"].get(
+            user,
+            attrs,
+            index.version,
+            lambda: runner(bot).call("nss", _render_check, index, user, attrs),
+        )
+        bot.say(reply)
     else:
         bot.say(f"{user} does not exist")
 
 
+def _render_check(index, user, attrs):
+    groups = [index.colored(index.group_name(attrs["gidNumber"]))]
+    groups.extend(index.colored(group) for group in index.groups(user))
+
+    if "creationTime" in attrs:
+        created = attrs["creationTime"].strftime("%Y-%m-%d")
+    else:
+        created = "unknown"
+
+    return "{user} ({uid}) | {name} | created {created} | groups: {groups}".format(
+        user=user,
+        uid=attrs["uidNumber"],
+        name=attrs["cn"][0],
+        created=created,
+        groups=", ".join(groups),
+    )
+
+
 def alphanum(word):
     return "".join(c for c in word.lower() if c in string.ascii_lowercase)
 
 
+def _search_ldap(pool, keywords):
+    """Search LDAP directly, for use until the search index is loaded."""
+    search_filter = "(&{})".format(
+        "".join(
+            # all keywords must match either uid or cn
+            "(|(uid=*{keyword}*)(cn=*{keyword}*))".format(keyword=keyword)
+            for keyword in keywords
+        ),
+    )
+
+    from ocflib.infra import ldap
+
+    response = pool.search(
+        ldap.OCF_LDAP_PEOPLE,
+        search_filter,
+        attributes=("uid", "cn"),
+        size_limit=CHECKACCT_MAX_RESULTS,
+    )
+
+    results = []
+    for entry in response:
+        uid = entry["attributes"]["uid"][0]
+        cn = entry["attributes"]["cn"][0]
+        rank = _rank(keywords, uid.lower(), cn.lower())
+        results.append((rank if rank is not None else len(keywords) * 3, uid, cn))
+    return [(uid, cn) for _, uid, cn in sorted(results)]
+
+
+def _reply_page(bot, trigger, results):
+    """Reply with the next page of results, saving the rest for !more."""
+    page = results[:CHECKACCT_PAGE_SIZE]
+    rest = results[CHECKACCT_PAGE_SIZE:]
+
+    message = ", ".join(f"{uid} ({cn})" for uid, cn in page)
+    cursors = bot.memory["check_cursors"]
+    if rest:
+        # each cursor can hold a long result list, so drop the ones nobody came
+        # back for, and the oldest ones past the cap; copies of the dict are
+        # taken because other handler threads may be changing it
+        now = time.monotonic()
+        for nick, (expires_at, _) in list(cursors.items()):
+            if expires_at < now:
+                cursors.pop(nick, None)
+        cursors.pop(trigger.nick, None)
+        for nick in list(cursors)[: max(len(cursors) - CHECKACCT_MAX_CURSORS + 1, 0)]:
+            cursors.pop(nick, None)
+
+        cursors[trigger.nick] = (now + CHECKACCT_CURSOR_TTL, rest)
+        message += " ({} more, say {}more)".format(
+            len(rest),
+            bot.settings.core.help_prefix,
+        )
+    else:
+        cursors.pop(trigger.nick, None)
+
+    bot.reply(message)
+
+
 @plugin.command("checkacct")
+@profiled
 def checkacct(bot, trigger):
-    """Print matching OCF usernames."""
+    """Print matching OCF usernames, best matches first."""
     search_term = trigger.group(2).strip()
-    keywords = search_term.split()
+    keywords = [alphanum(keyword) for keyword in search_term.split()]
 
     if len(keywords) > 0:
-        search = "(&{})".format(
-            "".join(
-                # all keywords must match either uid or cn
-                "(|(uid=*{keyword}*)(cn=*{keyword}*))".format(
-                    keyword=alphanum(keyword),
-                )
-                for keyword in keywords
-            ),
-        )
+        index = bot.memory["check_accounts"]
+        if index.ready:
+            results = index.search(keywords)
+        else:
+            results = runner(bot).call("ldap", _search_ldap, bot.memory["check_ldap"], keywords)
 
-        with ldap.ldap_ocf() as c:
-            c.search(
-                ldap.OCF_LDAP_PEOPLE,
-                search,
-                attributes=("uid", "cn"),
-                size_limit=5,
-            )
+        if len(results) > 0:
+            _reply_page(bot, trigger, results)
+        else:
+            bot.reply("no results found")
 
-            if len(c.response) > 0:
-                bot.reply(
-                    ", ".join(
-                        sorted(
-                            "{} ({})".format(
-                                entry["attributes"]["uid"][0],
-                                entry["attributes"]["cn"][0],
-                            )
-                            for entry in c.response
-                        ),
-                    ),
-                )
-            else:
-                bot.reply("no results found")
+
+@plugin.command("more")
+@profiled
+def more(bot, trigger):
+    """Print the next page of results from your last checkacct."""
+    cursor = bot.memory["check_cursors"].get(trigger.nick)
+    if cursor is None or cursor[0] < time.monotonic():
+        bot.memory["check_cursors"].pop(trigger.nick, None)
+        bot.reply("no more results")
+        return
+
+    _reply_page(bot, trigger, cursor[1])
@@ -1,38 +1,647 @@
 """Approve accounts."""
 
+import functools
+import queue
+import random
+import socket
 import ssl
 import textwrap
 import threading
 import time
+from collections import deque
+from collections import OrderedDict
+from fnmatch import fnmatch
 from traceback import format_exc
 
+from ocfplugins import plugin_importing
+from ocfplugins import profiled
+from ocfplugins import reloading
+from ocfplugins import runner
+from ocfplugins import state_outdated
+from ocfplugins import state_replaced
+from ocfplugins import timed_setup
 from sopel import plugin
+from sopel.config import ConfigurationError
 from sopel.config import types
-from celery import Celery
-from celery import exceptions
-from celery.events import EventReceiver
-from kombu import Connection
-from ocflib.account.submission import get_tasks
+from sopel.tools import get_logger
 
-IRC_CHANNELS_ANNOUNCE = "#administrivia"
-IRC_CHANNELS_OPER = "#root"
 
-tasks = None
+plugin_importing(__name__)
 
+LOGGER = get_logger("create")
+
+# where each ocflib event is announced, unless the announce_routes option is
+# set; each entry is an event type followed by one or more targets
+ANNOUNCE_ROUTES = [
+    "ocflib.account_submitted #root",
+    "ocflib.account_approved #administrivia",
+    "ocflib.account_rejected #administrivia",
+    "ocflib.account_created #administrivia",
+]
+ANNOUNCE_EVENTS = (
+    "ocflib.account_submitted",
+    "ocflib.account_approved",
+    "ocflib.account_rejected",
+    "ocflib.account_created",
+)
+
+# how long (in seconds) to wait for a worker to return the pending requests
+LIST_TIMEOUT = 5
+
+# how long (in seconds) to wait for a bulk approval or rejection to finish
+# before reporting on it
+BULK_TIMEOUT = 30
+
+# upper bounds (in seconds) of the buckets of the pipeline latency histograms,
+# from event relay times up to how long a request waits for approval
+LATENCY_BUCKETS = (
+    0.01, 0.05, 0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600, 4 * 3600, 86400, 7 * 86400,
+)
+# requests are forgotten if they're still in the pipeline after this many
+PIPELINE_MAX_TRACKED = 1000
+
+# how often (in seconds) the pending request cache is checked against the
+# database, in case we missed an event
+PENDING_RECONCILE_INTERVAL = 15 * 60
+# events are kept this long (in seconds) to replay onto a snapshot of the
+# pending requests that was requested before they arrived; snapshots come
+# back within LIST_TIMEOUT (plus sending the task) or are thrown away
+PENDING_REPLAY_WINDOW = 60
+
+# coalesced announcements of several events of the same kind, by event kind;
+# kinds without a summary (like submissions, which need reasons) are sent as is
+ANNOUNCE_SUMMARIES = {
+    "created": "{count} accounts created: {users}",
+    "approved": "{count} accounts approved, now pending creation: {users}",
+    "rejected": "{count} accounts rejected: {users}",
+}
+# a summary can be split over at most this many lines before being truncated
+ANNOUNCE_MAX_LINES = 3
+
+# the event receiver reconnects with exponential backoff (plus jitter) between
+# these bounds; the backoff resets once a connection has stayed up for a while
+RECEIVER_BACKOFF_MIN = 1
+RECEIVER_BACKOFF_MAX = 300
+RECEIVER_BACKOFF_RESET = 60
+# seconds between broker health checks
+RECEIVER_HEARTBEAT = 30
+# workers send heartbeat events every few seconds, so if nothing at all has
+# arrived for this many seconds, the consumer is assumed dead and restarted
+RECEIVER_WATCHDOG = 120
+# the bot's event queue outlives a reload, but events older than
+# RECEIVER_MESSAGE_TTL seconds are dropped, and the queue itself is deleted
+# after RECEIVER_QUEUE_EXPIRES seconds without a consumer; Redis ignores
+# both, so the queue is also purged when the bot starts
+RECEIVER_MESSAGE_TTL = 60
+RECEIVER_QUEUE_EXPIRES = 600
+# how many recent event ids are remembered to drop events seen twice
+RECEIVER_DEDUP_SIZE = 1024
+# how long (in seconds) shutdown waits for the background threads to stop;
+# the receiver notices within a second
+SHUTDOWN_TIMEOUT = 5
+
+# see ocfplugins.state_outdated()
+STATE_VERSION = 3
+
+# held while the Celery app is created, so that it only happens once
+celery_lock = threading.Lock()
+
+# admins waiting on the get_pending_requests task in flight, if there is one
+list_lock = threading.Lock()
+list_waiters = None
+
+
+def describe_request(request):
+    """Format a pending request like StoredNewAccountRequest.__str__ does.
+
+    Requests come from account_submitted events as dicts with a list of
+    reasons, and from get_pending_requests either as database rows (pickle)
+    or as dicts of their columns (JSON/msgpack).
+    """
+    if not isinstance(request, dict):
+        return str(request)
+
+    reason = request.get("reason")
+    if reason is None:
+        reason = str(request["reasons"])
+    return '{user} ({type}: "{real_name}"), because: {reason}'.format(
+        user=request["user_name"],
+        type="group" if request["is_group"] else "individual",
+        real_name=request["real_name"],
+        reason=reason,
+    )
+
+
+def request_user_name(request):
+    if isinstance(request, dict):
+        return request["user_name"]
+    return request.user_name
+
+
+class PendingRequests:
+    """Requests pending approval, kept current by the Celery event stream.
+
+    The cache is replaced now and then by a snapshot from
+    get_pending_requests, and events keep arriving while the snapshot is in
+    flight. So that the snapshot doesn't undo them, the changes from the last
+    PENDING_REPLAY_WINDOW seconds of events are kept, and those that arrived
+    after the snapshot was requested are applied on top of it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = {}
+        # (time.monotonic() it arrived, user name, description or None once
+        # the request isn't pending anymore), oldest first
+        self._changes = deque()
+        self.seeded = False
+        self.reconciled_at = None
+
+    def reset(self, requests, requested_at):
+        """Replace the cache with the result of get_pending_requests.
+
+        requested_at is the time.monotonic() the task was sent at.
+        """
+        with self._lock:
+            self._requests = {
+                request_user_name(request): describe_request(request)
+                for request in requests
+            }
+            for arrived_at, user_name, description in self._changes:
+                if arrived_at >= requested_at:
+                    self._set(user_name, description)
+            self.seeded = True
+            self.reconciled_at = time.time()
+
+    def _set(self, user_name, description):
+        if description is None:
+            self._requests.pop(user_name, None)
+        else:
+            self._requests[user_name] = description
+
+    def _change(self, user_name, description):
+        now = time.monotonic()
+        while self._changes and self._changes[0][0] < now - PENDING_REPLAY_WINDOW:
+            self._changes.popleft()
+        self._changes.append((now, user_name, description))
+        self._set(user_name, description)
+
+    def add(self, request):
+        """Add a request from an account_submitted event."""
+        with self._lock:
+            self._change(request["user_name"], describe_request(request))
+
+    def remove(self, request):
+        with self._lock:
+            self._change(request["user_name"], None)
+
+    def list(self):
+        with self._lock:
+            return [self._requests[user] for user in sorted(self._requests)]
+
+    def user_names(self):
+        with self._lock:
+            return sorted(self._requests)
+
+
+class LatencyHistogram:
+    """Cumulative histogram of latencies, with Prometheus-style buckets."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+
+    def quantile(self, q):
+        """Return the upper bound of the bucket holding the q-th quantile."""
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= q * self.count:
+                return bound
+        return float("inf")
+
+
+def format_seconds(seconds):
+    for unit, size in (("d", 86400), ("h", 3600), ("m", 60), ("s", 1)):
+        if seconds >= size:
+            return f"{seconds / size:.3g}{unit}"
+    return f"{seconds * 1000:.3g}ms"
+
+
+class PipelineLatency:
+    """Latency of each stage of the account pipeline, as seen from its events.
+
+    Stages between events (submitted to approved, approved to created, ...)
+    are measured with the timestamps the workers put on the events. relay is
+    how long events take to reach the bot, and announce how long they then
+    wait in the announcement queue.
+    """
+
+    STAGES = (
+        "relay",
+        "announce",
+        "submitted_to_approved",
+        "submitted_to_rejected",
+        "approved_to_created",
+        "submitted_to_created",
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {stage: LatencyHistogram() for stage in self.STAGES}
+        self._timelines = OrderedDict()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            self.histograms[stage].observe(max(seconds, 0))
+
+    def record(self, event):
+        """Record an event from the account pipeline as it is received."""
+        kind = event["type"].rpartition("_")[2]
+        user_name = event["request"]["user_name"]
+        timestamp = event["timestamp"]
+        self.observe("relay", time.time() - timestamp)
+
+        with self._lock:
+            timeline = self._timelines.setdefault(user_name, {})
+            timeline[kind] = timestamp
+            while len(self._timelines) > PIPELINE_MAX_TRACKED:
+                self._timelines.popitem(last=False)
+            if kind in ("created", "rejected"):
+                del self._timelines[user_name]
+
+        for start, end in (
+            ("submitted", "approved"),
+            ("submitted", "rejected"),
+            ("approved", "created"),
+            ("submitted", "created"),
+        ):
+            if kind == end and start in timeline:
+                self.observe(f"{start}_to_{end}", timestamp - timeline[start])
+
+    def stats(self):
+        with self._lock:
+            return [
+                "{stage}: n={count}, mean {mean}, p50 <= {p50}, p95 <= {p95}".format(
+                    stage=stage,
+                    count=histogram.count,
+                    mean=format_seconds(histogram.sum / histogram.count),
+                    p50=format_seconds(histogram.quantile(0.5)),
+                    p95=format_seconds(histogram.quantile(0.95)),
+                )
+                for stage, histogram in self.histograms.items()
+                if histogram.count
+            ] or ["no events yet"]
+
+    def metrics(self):
+        """Return the histograms in the Prometheus text format."""
+        lines = [
+            "# HELP ocf_create_pipeline_seconds Latency of the account pipeline by stage.",
+            "# TYPE ocf_create_pipeline_seconds histogram",
+        ]
+        with self._lock:
+            for stage, histogram in self.histograms.items():
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(
+                        f'ocf_create_pipeline_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}',
+                    )
+                lines.extend(
+                    (
+                        f'ocf_create_pipeline_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}',
+                        f'ocf_create_pipeline_seconds_sum{{stage="{stage}"}} {histogram.sum}',
+                        f'ocf_create_pipeline_seconds_count{{stage="{stage}"}} {histogram.count}',
+                    ),
+                )
+        return lines
+
+
+class AnnounceQueue:
+    """Bounded queue of announcements, sent to IRC by a separate thread.
+
+    bot.say blocks on the bot's flood protection, so the Celery event
+    receiver only enqueues messages and never waits on IRC. Every flush,
+    events of the same kind for the same channel become a single line.
+    When the queue is full, new announcements are dropped (and counted).
+    """
+
+    def __init__(self, size, pipeline):
+        self.size = size
+        self.pipeline = pipeline
+        self._queue = queue.Queue(maxsize=size)
+        self.high_water = 0
+        self.dropped = 0
+        self.sent = 0
+        self.coalesced = 0
+
+    def put(self, target, message, kind, user):
+        try:
+            self._queue.put_nowait((target, message, kind, user, time.monotonic()))
+        except queue.Full:
+            self.dropped += 1
+        else:
+            self.high_water = max(self.high_water, self._queue.qsize())
+
+    def flush(self, bot):
+        """Send everything in the queue, coalescing where possible."""
+        batches = {}
+        while True:
+            try:
+                target, message, kind, user, queued_at = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batches.setdefault((target, kind), []).append((message, user))
+            self.pipeline.observe("announce", time.monotonic() - queued_at)
+
+        for (target, kind), batch in batches.items():
+            if len(batch) > 1 and kind in ANNOUNCE_SUMMARIES:
+                bot.say(
+                    ANNOUNCE_SUMMARIES[kind].format(
+                        count=len(batch),
+                        users=", ".join(user for _, user in batch),
+                    ),
+                    target,
+                    max_messages=ANNOUNCE_MAX_LINES,
+                    truncation="…",
+                )
+                self.sent += 1
+                self.coalesced += len(batch)
+            else:
+                for message, _ in batch:
+                    bot.say(message, target)
+                    self.sent += 1
+
+    def stats(self):
+        return "announce queue: {depth}/{size} queued (max {high_water}), {sent} sent, {coalesced} coalesced, {dropped} dropped".format(
+            depth=self._queue.qsize(),
+            size=self.size,
+            high_water=self.high_water,
+            sent=self.sent,
+            coalesced=self.coalesced,
+            dropped=self.dropped,
+        )
+
+
+class EventReceiverState:
+    """Health of the Celery event receiver, and recently seen events.
+
+    Events redelivered after a reconnect are dropped by remembering the ids
+    of the last RECEIVER_DEDUP_SIZE events handled. An event whose handler
+    raised isn't remembered, so it's handled again if it's redelivered.
+    """
+
+    def __init__(self):
+        self._seen = set()
+        self._recent = deque()
+        self.reconnects = 0
+        self.watchdog_restarts = 0
+        self.errors = 0
+        self.duplicates = 0
+        self.last_event = None
+
+    @staticmethod
+    def _event_id(event):
+        return event.get("uuid") or (
+            event["type"],
+            event["hostname"],
+            event["pid"],
+            event["clock"],
+        )
+
+    def seen(self, event):
+        """Return whether the event was handled already."""
+        self.last_event = time.time()
+        if self._event_id(event) in self._seen:
+            self.duplicates += 1
+            return True
+        return False
+
+    def remember(self, event):
+        """Remember that the event was handled, to drop it if it's delivered again."""
+        event_id = self._event_id(event)
+        self._seen.add(event_id)
+        self._recent.append(event_id)
+        if len(self._recent) > RECEIVER_DEDUP_SIZE:
+            self._seen.discard(self._recent.popleft())
+
+    def stats(self):
+        return "event receiver: last event {last}, {reconnects} reconnects, {restarts} watchdog restarts, {errors} errors, {duplicates} duplicates dropped".format(
+            last=(
+                "{:.0f}s ago".format(time.time() - self.last_event)
+                if self.last_event is not None
+                else "never"
+            ),
+            reconnects=self.reconnects,
+            restarts=self.watchdog_restarts,
+            errors=self.errors,
+            duplicates=self.duplicates,
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def stoppable_event_receiver():
+    """Return an EventReceiver subclass whose capture() returns once a stop event is set.
+
+    It's defined on first use, so that loading the plugin doesn't import
+    celery.events.
+    """
+    from celery.events import EventReceiver
+
+    class StoppableEventReceiver(EventReceiver):
+        def __init__(self, *args, stop, **kwargs):
+            self._stop = stop
+            super().__init__(*args, **kwargs)
+
+        # checked by kombu's ConsumerMixin between polls of the connection
+        @property
+        def should_stop(self):
+            return self._stop.is_set()
+
+        @should_stop.setter
+        def should_stop(self, value):
+            if value:
+                self._stop.set()
+
+    return StoppableEventReceiver
+
+
+def event_receiver(bot, conn, stop=None, handlers=None):
+    """Make a receiver for the bot's own event queue.
+
+    The queue has a fixed name and isn't deleted when the receiver
+    disconnects, so events sent while the plugin is being reloaded wait in
+    it instead of being dropped. If the bot dies without deleting it, the
+    events in it are purged when the bot starts again.
+    """
+    return stoppable_event_receiver()(
+        conn,
+        app=celery_app(bot),
+        handlers=handlers,
+        node_id="ircbot-{}".format(bot.settings.core.nick),
+        queue_durable=True,
+        queue_ttl=RECEIVER_MESSAGE_TTL,
+        queue_expires=RECEIVER_QUEUE_EXPIRES,
+        stop=stop or threading.Event(),
+    )
+
+
+def delete_event_queue(bot):
+    """Delete the bot's event queue, so it doesn't fill up while the bot is down."""
+    if "create_celery" not in bot.memory:
+        # never connected, so there's no queue to delete
+        return
+    try:
+        with bot.memory["create_celery"].connection_for_write() as conn:
+            event_receiver(bot, conn).queue(conn.default_channel).delete()
+    except Exception:
+        LOGGER.exception("Failed to delete the Celery event queue")
 
 
 class CelerySection(types.StaticSection):
     broker = types.SecretAttribute("broker", str)
     backend = types.SecretAttribute("backend", str)
+    # serializer for task messages sent by the bot. Results are serialized by
+    # the workers, with their own result_serializer (pickle until they're
+    # changed), so the bot accepts results and events in this serializer,
+    # json, and anything else listed in accept_content; keep pickle listed
+    # there while the workers still send it
+    serializer = types.ChoiceAttribute(
+        "serializer",
+        choices=["pickle", "json", "msgpack"],
+        default="pickle",
+    )
+    accept_content = types.ListAttribute("accept_content", default=[])
+    # seconds between flushes of the announcement queue
+    announce_flush_interval = types.ValidatedAttribute(
+        "announce_flush_interval",
+        float,
+        default=2,
+    )
+    announce_queue_size = types.ValidatedAttribute(
+        "announce_queue_size",
+        int,
+        default=1000,
+    )
+    # one "<event type> <target> [<target> ...]" entry per line
+    announce_routes = types.ListAttribute(
+        "announce_routes",
+        default=ANNOUNCE_ROUTES,
+    )
+
+
+def compile_routes(routes):
+    """Turn announce_routes entries into a map of event type to targets.
+
+    Entries for the same event type are merged, and each target is only
+    listed once per event type.
+    """
+    compiled = {}
+    for route in routes:
+        event_type, *targets = route.split()
+        if event_type not in ANNOUNCE_EVENTS:
+            raise ConfigurationError(
+                "Unknown event type {!r} in celery.announce_routes, expected one of {}".format(
+                    event_type,
+                    ", ".join(ANNOUNCE_EVENTS),
+                ),
+            )
+        if not targets:
+            raise ConfigurationError(f"No targets for {event_type} in celery.announce_routes")
+        existing = compiled.get(event_type, ())
+        compiled[event_type] = existing + tuple(
+            target for target in dict.fromkeys(targets) if target not in existing
+        )
+    return compiled
 
 
+def make_celery(bot):
+    """Create the Celery app shared by the command handlers and the listener."""
+    from celery import Celery
+
+    celery = Celery(
+        broker=bot.settings.celery.broker,
+        backend=bot.settings.celery.backend,
+    )
+    celery.conf.broker_use_ssl = {
+        "ssl_ca_certs": "/etc/ssl/certs/ca-certificates.crt",
+        "ssl_cert_reqs": ssl.CERT_REQUIRED,
+    }
+    celery.conf.broker_transport_options = {
+        "health_check_interval": RECEIVER_HEARTBEAT,
+    }
+
+    celery.conf.redis_backend_use_ssl = {
+        "ssl_ca_certs": "/etc/ssl/certs/ca-certificates.crt",
+        "ssl_cert_reqs": ssl.CERT_REQUIRED,
+    }
+
+    celery.conf.task_serializer = bot.settings.celery.serializer
+    celery.conf.accept_content = set(bot.settings.celery.accept_content) | {
+        bot.settings.celery.serializer,
+        "json",
+    }
+    celery.conf.result_accept_content = celery.conf.accept_content
+
+    return celery
+
+
+def celery_app(bot):
+    """Return the Celery app, creating it and ocflib's tasks on first use.
+
+    The listener thread asks for it as soon as it starts, so it's normally
+    ready before the first command.
+    """
+    with celery_lock:
+        if "create_celery" not in bot.memory:
+            from ocflib.account.submission import get_tasks
+
+            celery = make_celery(bot)
+            bot.memory["create_tasks"] = get_tasks(celery)
+            bot.memory["create_celery"] = celery
+    return bot.memory["create_celery"]
+
+
+def celery_tasks(bot):
+    """Return ocflib's account submission tasks, on the shared Celery app."""
+    celery_app(bot)
+    return bot.memory["create_tasks"]
+
+
+@timed_setup
 def setup(bot):
     bot.settings.define_section("celery", CelerySection)
+    bot.memory["create_routes"] = compile_routes(bot.settings.celery.announce_routes)
+    # when the plugin is reloaded, the Celery app (and its connections), the
+    # pending requests and the recently seen events of the previous version
+    # are kept, unless their classes changed
+    if state_outdated(bot, "create", STATE_VERSION):
+        # the Celery app is created again on first use
+        bot.memory.pop("create_celery", None)
+        bot.memory.pop("create_tasks", None)
+        bot.memory["create_pending"] = PendingRequests()
+        bot.memory["create_receiver"] = EventReceiverState()
+        bot.memory["create_pipeline"] = PipelineLatency()
+        bot.memory["create_announce"] = AnnounceQueue(
+            bot.settings.celery.announce_queue_size,
+            bot.memory["create_pipeline"],
+        )
+        state_replaced(bot, "create", STATE_VERSION)
+    bot.memory.setdefault("stats", {})["create"] = stats
+    bot.memory["stats"]["pipeline"] = pipeline_stats
+    bot.memory.setdefault("metrics", {})["create"] = metrics
+
+    stop = bot.memory["create_stop"] = threading.Event()
 
     def add_thread(func):
         def thread_func():
             try:
-                func(bot)
+                func(bot, stop)
             except Exception as ex:
                 error_msg = "ircbot exception in thread {thread}.{function}: {exception}".format(
                     thread=func.__module__,
@@ -60,86 +669,293 @@ def setup(bot):
 
         thread = threading.Thread(target=thread_func, daemon=True)
         thread.start()
+        return thread
+
+    bot.memory["create_threads"] = [
+        add_thread(celery_listener),
+        add_thread(announce_flusher),
+    ]
 
-    add_thread(celery_listener)
+
+def shutdown(bot):
+    stop = bot.memory.pop("create_stop", None)
+    if stop is None:
+        return
+    stop.set()
+    for thread in bot.memory.pop("create_threads", ()):
+        thread.join(SHUTDOWN_TIMEOUT)
+
+    # unless the next version takes over, the bot is exiting, and nothing will
+    # read the event queue for a while
+    if not reloading(bot, "create"):
+        delete_event_queue(bot)
+
+
+def stats(bot):
+    """Return statistics about the create plugin, for !stats."""
+    return [
+        bot.memory["create_receiver"].stats(),
+        bot.memory["create_announce"].stats(),
+    ]
+
+
+def pipeline_stats(bot):
+    """Return the latency of each stage of the account pipeline, for !stats."""
+    return bot.memory["create_pipeline"].stats()
+
+
+def metrics(bot):
+    """Return the create plugin's Prometheus metrics."""
+    return bot.memory["create_pipeline"].metrics()
+
+
+def announce_flusher(bot, stop):
+    """Send queued announcements to IRC every flush interval, until stop is set."""
+    announcements = bot.memory["create_announce"]
+    while not stop.wait(bot.settings.celery.announce_flush_interval):
+        try:
+            announcements.flush(bot)
+        except Exception:
+            LOGGER.exception("Failed to send announcements")
+
+
+def bulk_user_names(bot, trigger):
+    """Return the user names a bulk approve or reject applies to.
+
+    These are either the user names given, or with --all-matching, every
+    pending request matching one of the given shell-style patterns.
+    """
+    args = (trigger.group(2) or "").split()
+    if args[:1] != ["--all-matching"]:
+        return args
+
+    pending = bot.memory["create_pending"]
+    if not pending.seeded:
+        return None
+    return [
+        user_name
+        for user_name in pending.user_names()
+        if any(fnmatch(user_name, pattern) for pattern in args[1:])
+    ]
+
+
+def valid_bulk_args(args):
+    """Return whether args are user names, or --all-matching then patterns."""
+    if args[:1] == ["--all-matching"]:
+        args = args[1:]
+    return bool(args) and not any(arg.startswith("--") for arg in args)
+
+
+def bulk_dispatch(bot, trigger, task, verb):
+    """Send one task per user in a single batch, then report on all of them."""
+    user_names = bulk_user_names(bot, trigger)
+    if user_names is None:
+        bot.reply("pending requests aren't loaded yet, list them by name")
+        return
+    elif not user_names:
+        bot.reply("no matching requests")
+        return
+
+    from celery import group
+
+    # a group publishes all of its messages on one producer connection
+    result = runner(bot).call("celery", group(task.s(user_name) for user_name in user_names).apply_async)
+    bot.reply(
+        "{} {} accounts, results to follow: {}".format(
+            verb,
+            len(user_names),
+            ", ".join(user_names),
+        ),
+    )
+    threading.Thread(
+        target=report_bulk,
+        args=(bot, trigger.sender, trigger.nick, verb, user_names, result),
+        daemon=True,
+    ).start()
+
+
+def report_bulk(bot, sender, nick, verb, user_names, result):
+    """Wait for the tasks of a bulk command, then reply with how each went."""
+    from celery import exceptions
+
+    deadline = time.monotonic() + BULK_TIMEOUT
+    done, failed, waiting = [], [], []
+    for user_name, child in zip(user_names, result.results):
+        try:
+            child.get(timeout=max(deadline - time.monotonic(), 0), propagate=False)
+        except exceptions.TimeoutError:
+            waiting.append(user_name)
+            continue
+
+        if child.successful():
+            done.append(user_name)
+        else:
+            failed.append(f"{user_name} ({child.result!r})")
+
+    summary = [f"{verb} {len(done)}/{len(user_names)}"]
+    if failed:
+        summary.append("failed: {}".format(", ".join(failed)))
+    if waiting:
+        summary.append("still queued: {}".format(", ".join(waiting)))
+    bot.reply("; ".join(summary), sender, nick)
 
 
 @plugin.command("approve")
 @plugin.require_admin(reply=True)
+@profiled
 def approve(bot, trigger):
-    """Approve a pending account."""
-    user_name = trigger.group(2)
-    tasks.approve_request.delay(user_name)
-    bot.reply(f"approved {user_name}, the account is being created")
+    """Approve pending accounts, by name or with --all-matching <pattern>."""
+    args = (trigger.group(2) or "").split()
+    if not valid_bulk_args(args):
+        bot.reply("usage: !approve <user>... | !approve --all-matching <pattern>...")
+    elif len(args) == 1:
+        runner(bot).call("celery", celery_tasks(bot).approve_request.delay, args[0])
+        bot.reply(f"approved {args[0]}, the account is being created")
+    else:
+        bulk_dispatch(bot, trigger, celery_tasks(bot).approve_request, "approved")
 
 
 @plugin.command("reject")
 @plugin.require_admin(reply=True)
+@profiled
 def reject(bot, trigger):
-    """Reject a pending account."""
-    user_name = trigger.group(2)
-    tasks.reject_request.delay(user_name)
-    bot.reply(f"rejected {user_name}, better luck next time")
+    """Reject pending accounts, by name or with --all-matching <pattern>."""
+    args = (trigger.group(2) or "").split()
+    if not valid_bulk_args(args):
+        bot.reply("usage: !reject <user>... | !reject --all-matching <pattern>...")
+    elif len(args) == 1:
+        runner(bot).call("celery", celery_tasks(bot).reject_request.delay, args[0])
+        bot.reply(f"rejected {args[0]}, better luck next time")
+    else:
+        bulk_dispatch(bot, trigger, celery_tasks(bot).reject_request, "rejected")
 
 
 @plugin.command("list")
 @plugin.require_admin(reply=True)
+@profiled
 def list_pending(bot, trigger):
     """List accounts pending approval."""
-    task = tasks.get_pending_requests.delay()
-    try:
-        task.wait(timeout=5)
-        if task.result:
-            for request in task.result:
+    global list_waiters
+
+    pending = bot.memory["create_pending"]
+    if pending.seeded:
+        requests = pending.list()
+        if requests:
+            for request in requests:
                 bot.reply(request)
         else:
             bot.reply("no pending requests")
+        return
+
+    with list_lock:
+        if list_waiters is not None:
+            # piggyback on the request that is already in flight
+            list_waiters.append((trigger.sender, trigger.nick))
+            return
+        list_waiters = [(trigger.sender, trigger.nick)]
+
+    requested_at = time.monotonic()
+    try:
+        task = runner(bot).call("celery", celery_tasks(bot).get_pending_requests.delay)
+    except Exception as ex:
+        # the admins who piggybacked on this request are waiting on it too
+        LOGGER.exception("Failed to ask for the pending requests")
+        reply_waiters(bot, [f"failed to load list of requests: {ex}"])
+        return
+
+    threading.Thread(
+        target=reply_pending,
+        args=(bot, task, requested_at),
+        daemon=True,
+    ).start()
+
+
+def reply_waiters(bot, replies):
+    """Reply to everyone waiting on the request in flight, which is then done."""
+    global list_waiters
+
+    with list_lock:
+        waiters, list_waiters = list_waiters, None
+
+    for sender, nick in waiters:
+        for reply in replies:
+            bot.reply(reply, sender, nick)
+
+
+def reply_pending(bot, task, requested_at):
+    """Wait for the pending requests, then reply to everyone who asked for them."""
+    from celery import exceptions
+
+    try:
+        task.wait(timeout=LIST_TIMEOUT)
+        bot.memory["create_pending"].reset(task.result, requested_at)
+        if task.result:
+            replies = [describe_request(request) for request in task.result]
+        else:
+            replies = ["no pending requests"]
     except exceptions.TimeoutError:
-        bot.reply("timed out loading list of requests, sorry!")
+        replies = ["timed out loading list of requests, sorry!"]
+    except Exception as ex:
+        # the task raised, or its result couldn't be decoded; everyone waiting
+        # still gets an answer
+        LOGGER.exception("Failed to list the pending requests")
+        replies = [f"failed to load list of requests: {ex!r}"]
 
+    reply_waiters(bot, replies)
 
-def celery_listener(bot):
-    """Listen for events from Celery, relay to IRC."""
-    global tasks
 
-    while len(bot.channels.keys()) <= 0:
-        time.sleep(2)
+def reconcile_pending(bot):
+    """Reload the pending request cache from the database."""
+    requested_at = time.monotonic()
+    task = celery_tasks(bot).get_pending_requests.delay()
+    bot.memory["create_pending"].reset(task.get(timeout=LIST_TIMEOUT), requested_at)
 
-    celery = Celery(
-        broker=bot.settings.celery.broker,
-        backend=bot.settings.celery.backend,
-    )
-    celery.conf.broker_use_ssl = {
-        "ssl_ca_certs": "/etc/ssl/certs/ca-certificates.crt",
-        "ssl_cert_reqs": ssl.CERT_REQUIRED,
-    }
 
-    celery.conf.redis_backend_use_ssl = {
-        "ssl_ca_certs": "/etc/ssl/certs/ca-certificates.crt",
-        "ssl_cert_reqs": ssl.CERT_REQUIRED,
-    }
+@plugin.interval(PENDING_RECONCILE_INTERVAL)
+def reconcile(bot):
+    """Periodically catch up on any events the pending request cache missed."""
+    reconcile_pending(bot)
 
-    # TODO: stop using pickle
-    celery.conf.task_serializer = "pickle"
-    celery.conf.result_serializer = "pickle"
-    celery.conf.accept_content = {"pickle"}
 
-    tasks = get_tasks(celery)
+def celery_listener(bot, stop):
+    """Listen for events from Celery, relay to IRC, until stop is set."""
+    celery = celery_app(bot)
 
-    connection = Connection(
-        bot.settings.celery.broker,
-        ssl={
-            "ssl_ca_certs": "/etc/ssl/certs/ca-certificates.crt",
-            "ssl_cert_reqs": ssl.CERT_REQUIRED,
-        },
-    )
+    # open a broker connection now, so the first command doesn't wait for the
+    # TCP and TLS handshakes; it goes back into the app's pool for .delay()
+    try:
+        with celery.producer_or_acquire() as producer:
+            producer.connection.ensure_connection(max_retries=3)
+    except Exception:
+        # the receiver loop below keeps retrying until the broker is back
+        LOGGER.exception("Failed to connect to the Celery broker")
+
+    if not bot.memory["create_pending"].seeded:
+        try:
+            reconcile_pending(bot)
+        except Exception:
+            # !list falls back to asking a worker until the next reconcile works
+            LOGGER.exception("Failed to load the pending requests")
+
+    while len(bot.channels.keys()) <= 0:
+        if stop.wait(2):
+            return
+
+    connection = celery.connection_for_read(heartbeat=RECEIVER_HEARTBEAT)
 
-    def bot_announce(targets, message):
-        for target in targets:
-            bot.say(message, target)
+    announcements = bot.memory["create_announce"]
+
+    routes = bot.memory["create_routes"]
+
+    def bot_announce(event, message, kind, user):
+        for target in routes.get(event["type"], ()):
+            announcements.put(target, message, kind, user)
+
+    pending = bot.memory["create_pending"]
 
     def on_account_created(event):
         request = event["request"]
+        pending.remove(request)
 
         if request["calnet_uid"]:
             uid_or_gid = "Calnet UID: {}".format(request["calnet_uid"])
@@ -149,53 +965,122 @@ def celery_listener(bot):
             uid_or_gid = "No Calnet UID or OID set"
 
         bot_announce(
-            IRC_CHANNELS_ANNOUNCE,
+            event,
             "{user} created ({real_name}, {uid_or_gid})".format(
                 user=request["user_name"],
                 real_name=request["real_name"],
                 uid_or_gid=uid_or_gid,
             ),
+            "created",
+            request["user_name"],
         )
 
     def on_account_submitted(event):
         request = event["request"]
+        pending.add(request)
         bot_announce(
-            IRC_CHANNELS_OPER,
+            event,
             "{user} ({real_name}) needs approval: {reasons}".format(
                 user=request["user_name"],
                 real_name=request["real_name"],
                 reasons=", ".join(request["reasons"]),
             ),
+            "submitted",
+            request["user_name"],
         )
 
     def on_account_approved(event):
         request = event["request"]
+        pending.remove(request)
         bot_announce(
-            IRC_CHANNELS_ANNOUNCE,
+            event,
             "{user} was approved, now pending creation.".format(
                 user=request["user_name"],
             ),
+            "approved",
+            request["user_name"],
         )
 
     def on_account_rejected(event):
         request = event["request"]
+        pending.remove(request)
         bot_announce(
-            IRC_CHANNELS_ANNOUNCE,
+            event,
             "{user} was rejected.".format(
                 user=request["user_name"],
             ),
+            "rejected",
+            request["user_name"],
         )
 
-    while True:
-        with connection as conn:
-            recv = EventReceiver(
-                conn,
-                app=celery,
-                handlers={
-                    "ocflib.account_created": on_account_created,
-                    "ocflib.account_submitted": on_account_submitted,
-                    "ocflib.account_approved": on_account_approved,
-                    "ocflib.account_rejected": on_account_rejected,
-                },
+    receiver = bot.memory["create_receiver"]
+    pipeline = bot.memory["create_pipeline"]
+
+    def handle(handler):
+        def handle_event(event):
+            try:
+                if receiver.seen(event):
+                    return
+                pipeline.record(event)
+                handler(event)
+            except Exception:
+                # e.g. a malformed event; the ones after it are still handled
+                LOGGER.exception("Failed to handle Celery event %s", event.get("type"))
+            else:
+                receiver.remember(event)
+
+        return handle_event
+
+    handlers = {
+        "ocflib.account_created": handle(on_account_created),
+        "ocflib.account_submitted": handle(on_account_submitted),
+        "ocflib.account_approved": handle(on_account_approved),
+        "ocflib.account_rejected": handle(on_account_rejected),
+    }
+    # kombu wraps errors connecting to the broker in OperationalError
+    from kombu.exceptions import OperationalError
+
+    connection_errors = (
+        connection.connection_errors + connection.channel_errors + (OperationalError,)
+    )
+    backoff = RECEIVER_BACKOFF_MIN
+
+    while not stop.is_set():
+        connected_at = time.monotonic()
+        try:
+            with connection as conn:
+                recv = event_receiver(bot, conn, stop, handlers)
+                if not bot.memory.get("create_queue_purged"):
+                    # left over from before a crash or kill, when shutdown()
+                    # didn't get to delete it; these events are stale, and
+                    # the pending requests were just reloaded anyway
+                    event_queue = recv.queue(conn.default_channel)
+                    event_queue.declare()
+                    purged = event_queue.purge()
+                    if purged:
+                        LOGGER.info("Dropped %s stale events from the Celery event queue", purged)
+                    bot.memory["create_queue_purged"] = True
+                # raises socket.timeout if nothing arrives within the window,
+                # returns once stop is set
+                recv.capture(limit=None, timeout=RECEIVER_WATCHDOG)
+        except socket.timeout:
+            receiver.watchdog_restarts += 1
+            LOGGER.warning(
+                "No Celery events for %ss, restarting the receiver",
+                RECEIVER_WATCHDOG,
             )
-            recv.capture(limit=None, timeout=None)
+            continue
+        except connection_errors:
+            receiver.reconnects += 1
+            LOGGER.exception("Lost connection to the Celery broker")
+        except Exception:
+            # e.g. an event that can't be decoded, or an error from the broker;
+            # if this thread died, nothing would announce events until the bot
+            # restarts
+            receiver.errors += 1
+            LOGGER.exception("The Celery event receiver failed, restarting it")
+
+        if time.monotonic() - connected_at > RECEIVER_BACKOFF_RESET:
+            backoff = RECEIVER_BACKOFF_MIN
+        stop.wait(backoff / 2 + random.uniform(0, backoff / 2))
+        backoff = min(backoff * 2, RECEIVER_BACKOFF_MAX)
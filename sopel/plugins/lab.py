@@ -1,19 +1,185 @@
 """Get information about the lab."""
 
-from ocflib.lab.stats import staff_in_lab
-from ocflib.lab.stats import users_in_lab_count
+import functools
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
 
+from ocfplugins import plugin_importing
+from ocfplugins import profiled
+from ocfplugins import runner
+from ocfplugins import timed_setup
 from sopel import plugin
+from sopel.config import types
+from sopel.tools import get_logger
+
+
+plugin_importing(__name__)
+
+LOGGER = get_logger("lab")
+
+# how long (in seconds) a snapshot of the lab is reused before querying again,
+# when the background poller is disabled
+LAB_SNAPSHOT_TTL = 5
+
+
+class LabSection(types.StaticSection):
+    # seconds between polls of the stats database, 0 to only query on demand
+    poll_interval = types.ValidatedAttribute("poll_interval", float, default=10)
+    # channel to announce staff arriving in and leaving the lab to, if any
+    announce_channel = types.ValidatedAttribute("announce_channel", default=None)
+
+
+class LabSnapshot(namedtuple("LabSnapshot", ("staff", "total", "taken_at"))):
+    """Staff sessions and number of users in the lab at some point in time.
+
+    staff maps the username of each staffer in the lab to their session (the
+    earliest one, if they are logged in on more than one desktop).
+    """
+
+    def age(self):
+        return time.monotonic() - self.taken_at
+
+
+class LabState:
+    """Short-lived cache of the lab's state, shared by all the handlers.
+
+    The first caller after the snapshot expires queries the stats database;
+    concurrent callers wait for that query instead of making their own, so a
+    burst of messages costs one query. Nothing is locked while the query
+    runs, so when it is made on the ocf plugin's backend threads, everyone
+    waiting for it gives up at the backend's deadline.
+    """
+
+    def __init__(self, ttl=LAB_SNAPSHOT_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._snapshot = None
+        # the query in flight, if any
+        self._query = None
+
+    def get(self, call=None):
+        """Return a snapshot of the lab no older than the TTL.
+
+        The query is made by call(func), e.g. on the ocf plugin's backend
+        threads, or directly if call isn't set.
+        """
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.age() < self.ttl:
+            return snapshot
+        return self.refresh(call)
+
+    def _refresh(self):
+        from ocflib.lab.stats import staff_in_lab
+        from ocflib.lab.stats import users_in_lab_count
+
+        sessions = sorted(staff_in_lab(), key=lambda session: session.start, reverse=True)
+        snapshot = self._snapshot = LabSnapshot(
+            staff={session.user: session for session in sessions},
+            total=users_in_lab_count(),
+            taken_at=time.monotonic(),
+        )
+        return snapshot
+
+    def refresh(self, call=None):
+        """Query the stats database for a new snapshot and return it.
+
+        If a query is already in flight, this waits for its result instead,
+        or its error (like the backend timing out).
+        """
+        with self._lock:
+            query = self._query
+            if query is None:
+                query = self._query = Future()
+                running = True
+            else:
+                running = False
+
+        if running:
+            try:
+                query.set_result(self._refresh() if call is None else call(self._refresh))
+            except BaseException as ex:
+                query.set_exception(ex)
+            finally:
+                with self._lock:
+                    self._query = None
+        return query.result()
+
+
+def _announce_changes(bot, previous, current):
+    """Announce staff who arrived in or left the lab between two snapshots."""
+    channel = bot.settings.lab.announce_channel
+    if not channel or previous is None:
+        return
+
+    before = previous.staff.keys()
+    after = current.staff.keys()
+    for verb, staff in (("arrived in", after - before), ("left", before - after)):
+        if staff:
+            bot.say(
+                "{} {} the lab".format(
+                    ", ".join(sorted(_prevent_ping(staffer) for staffer in staff)),
+                    verb,
+                ),
+                channel,
+            )
+
+
+def poll_lab(bot, stop):
+    """Keep the lab snapshot up to date at a fixed rate, until stop is set."""
+    state = bot.memory["lab_state"]
+    previous = None
+    while not stop.is_set():
+        try:
+            current = state.refresh(call=functools.partial(runner(bot).call, "labdb"))
+        except Exception:
+            LOGGER.exception("Failed to poll the lab stats database")
+        else:
+            _announce_changes(bot, previous, current)
+            previous = current
+        stop.wait(bot.settings.lab.poll_interval)
+
+
+@timed_setup
+def setup(bot):
+    bot.settings.define_section("lab", LabSection)
+
+    interval = bot.settings.lab.poll_interval
+    if interval > 0:
+        # handlers only query the database themselves if the poller falls behind
+        bot.memory["lab_state"] = LabState(ttl=3 * interval)
+        bot.memory["lab_poller"] = threading.Event()
+        threading.Thread(
+            target=poll_lab,
+            args=(bot, bot.memory["lab_poller"]),
+            daemon=True,
+        ).start()
+    else:
+        bot.memory["lab_state"] = LabState()
+
+
+def shutdown(bot):
+    stop = bot.memory.pop("lab_poller", None)
+    if stop is not None:
+        stop.set()
 
 
 @plugin.rule(r"is ([a-z]+) in the lab")
+@profiled
 def in_lab(bot, trigger):
     """Check if a staffer is in the lab."""
-    username = trigger.group(2).strip()
-    for session in staff_in_lab():
-        if username == session.user:
-            bot.reply(f"{username} is in the lab")
-            break
+    username = trigger.group(1).strip()
+    snapshot = bot.memory["lab_state"].get(call=functools.partial(runner(bot).call, "labdb"))
+    session = snapshot.staff.get(username)
+    if session is not None:
+        bot.reply(
+            "{} is in the lab, on {} since {:%H:%M}".format(
+                username,
+                session.host,
+                session.start,
+            ),
+        )
     else:
         bot.reply(f"{username} is not in the lab")
 
@@ -24,10 +190,12 @@ def _prevent_ping(staffer):
 
 
 @plugin.rule(r"(who is|who's) in the lab", r"(?i)w+i+t+l+")
+@profiled
 def who_is_in_lab(bot, trigger):
     """Report on who is currently in the lab."""
-    staff = {session.user for session in staff_in_lab()}
-    total = users_in_lab_count()
+    snapshot = bot.memory["lab_state"].get(call=functools.partial(runner(bot).call, "labdb"))
+    staff = snapshot.staff.keys()
+    total = snapshot.total
 
     if total != 1:
         are_number_people = f"are {total} people"
@@ -0,0 +1,581 @@
+"""Admin tools shared by the other OCF plugins."""
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+from collections import defaultdict
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from queue import SimpleQueue
+
+from ocfplugins import load_times
+from ocfplugins import plugin_importing
+from ocfplugins import reloading
+from ocfplugins import state_outdated
+from ocfplugins import state_replaced
+from ocfplugins import timed_setup
+from sopel import plugin
+from sopel.config import types
+from sopel.tools import events
+from sopel.tools import get_logger
+
+
+plugin_importing(__name__)
+
+LOGGER = get_logger("ocf")
+
+# percentiles of command timings are computed over this many recent calls
+COMMAND_SAMPLES = 1024
+
+# blocking calls to backends run on this many shared threads; each backend
+# runs at most `limit` calls at once, and commands wait up to `timeout`
+# seconds for a call before giving up on it
+BACKEND_WORKERS = 12
+BACKEND_LIMITS = {
+    # (limit, timeout); the check plugin's LDAP pool has 4 connections
+    "ldap": (4, 10),
+    # NSS is backed by LDAP as well
+    "nss": (2, 10),
+    "labdb": (2, 5),
+    "celery": (4, 5),
+}
+BACKEND_DEFAULT_LIMITS = (2, 10)
+
+# see ocfplugins.state_outdated()
+STATE_VERSION = 3
+
+
+class OCFSection(types.StaticSection):
+    # port to serve Prometheus metrics (/metrics) and command timings
+    # (/commands.json) on, 0 to disable
+    metrics_port = types.ValidatedAttribute("metrics_port", int, default=0)
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class CommandTiming:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.wall = deque(maxlen=COMMAND_SAMPLES)
+        self.backend = deque(maxlen=COMMAND_SAMPLES)
+
+    def summary(self):
+        wall = list(self.wall)
+        backend = sum(self.backend) / len(self.backend)
+        mean = sum(wall) / len(wall)
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "wall_mean": mean,
+            "wall_p50": percentile(wall, 0.5),
+            "wall_p95": percentile(wall, 0.95),
+            "wall_p99": percentile(wall, 0.99),
+            "backend_mean": backend,
+            "format_mean": mean - backend,
+        }
+
+
+class CommandStats:
+    """Timing of the OCF plugins' commands.
+
+    The CommandRunner the other plugins share runs their commands through
+    call(), and their calls to LDAP, the lab database, Celery and so on
+    through backend(), so the wall time of a command is split between
+    waiting on backends and everything else (mostly formatting). A single
+    call of a command can be run under cProfile, with the profile saved to
+    the bot's home directory.
+    """
+
+    def __init__(self, profile_dir):
+        self.profile_dir = profile_dir
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.commands = defaultdict(CommandTiming)
+        self.backends = defaultdict(float)
+        self.profile_next = set()
+
+    def call(self, func, bot, trigger):
+        name = func.__name__
+        with self._lock:
+            profiler = cProfile.Profile() if name in self.profile_next else None
+            self.profile_next.discard(name)
+
+        self._local.backend = 0.0
+        failed = False
+        start = time.perf_counter()
+        try:
+            if profiler is not None:
+                return profiler.runcall(func, bot, trigger)
+            return func(bot, trigger)
+        except BackendTimeout as ex:
+            failed = True
+            bot.reply(str(ex))
+        except Exception:
+            failed = True
+            raise
+        finally:
+            wall = time.perf_counter() - start
+            with self._lock:
+                timing = self.commands[name]
+                timing.calls += 1
+                timing.errors += failed
+                timing.wall.append(wall)
+                timing.backend.append(self._local.backend)
+            if profiler is not None:
+                bot.reply(self._save_profile(name, profiler, wall))
+
+    def profile(self, name):
+        """Run the next call of the named command under cProfile."""
+        with self._lock:
+            self.profile_next.add(name)
+
+    @contextmanager
+    def backend(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._local.backend = getattr(self._local, "backend", 0.0) + elapsed
+            with self._lock:
+                self.backends[name] += elapsed
+
+    def _save_profile(self, name, profiler, wall):
+        path = os.path.join(
+            self.profile_dir,
+            "profile-{}-{}.prof".format(name, time.strftime("%Y%m%d-%H%M%S")),
+        )
+        profiler.dump_stats(path)
+
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(20)
+        with open(path[: -len(".prof")] + ".txt", "w") as f:
+            f.write(out.getvalue())
+
+        return "profiled {} ({:.1f}ms), saved to {}".format(name, wall * 1000, path)
+
+    def summary(self):
+        with self._lock:
+            return {
+                "commands": {
+                    name: timing.summary() for name, timing in self.commands.items()
+                },
+                "backend_seconds": dict(self.backends),
+            }
+
+    def stats(self):
+        summary = self.summary()
+        lines = [
+            "{name}: {calls} calls, {errors} errors, p50 {p50:.1f}ms, p95 {p95:.1f}ms, p99 {p99:.1f}ms, mean {backend:.1f}ms backend + {format:.1f}ms other".format(
+                name=name,
+                calls=timing["calls"],
+                errors=timing["errors"],
+                p50=timing["wall_p50"] * 1000,
+                p95=timing["wall_p95"] * 1000,
+                p99=timing["wall_p99"] * 1000,
+                backend=timing["backend_mean"] * 1000,
+                format=timing["format_mean"] * 1000,
+            )
+            for name, timing in sorted(summary["commands"].items())
+        ]
+        if summary["backend_seconds"]:
+            lines.append(
+                "backend time: {}".format(
+                    ", ".join(
+                        f"{name} {seconds:.1f}s"
+                        for name, seconds in sorted(summary["backend_seconds"].items())
+                    ),
+                ),
+            )
+        return lines or ["no commands run yet"]
+
+
+class BackendTimeout(TimeoutError):
+    """A backend call didn't finish before the backend's deadline."""
+
+    def __init__(self, name, timeout):
+        super().__init__(name, timeout)
+        self.name = name
+        self.timeout = timeout
+
+    def __str__(self):
+        return f"{self.name} didn't answer within {self.timeout:g}s, try again later"
+
+
+class BackendQueue:
+    """Calls to one backend, waiting for a free slot or running."""
+
+    def __init__(self, limit, timeout):
+        self.limit = limit
+        self.timeout = timeout
+        self.waiting = deque()
+        self.running = 0
+        self.max_waiting = 0
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+
+
+class BackendExecutor:
+    """Shared threads for the OCF plugins' blocking calls to LDAP, NSS and so on.
+
+    Each backend has a limit on how many of its calls run at once, and calls
+    over the limit wait in that backend's queue, so a slow backend only ties
+    up its own share of the threads. Commands wait for a call up to the
+    backend's deadline, then give up: a call still waiting is dropped, and
+    one already running keeps its slot until it returns.
+    """
+
+    def __init__(self, workers=BACKEND_WORKERS, limits=BACKEND_LIMITS):
+        self.workers = workers
+        self.limits = limits
+        self._lock = threading.Lock()
+        self._jobs = SimpleQueue()
+        self.backends = {}
+        for _ in range(workers):
+            # daemon threads, so that a call stuck on a backend can't keep the
+            # bot from exiting
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            self._run(*job)
+
+    def _run(self, backend, future, func, args, kwargs):
+        ran = future.set_running_or_notify_cancel()
+        if ran:
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as ex:
+                future.set_exception(ex)
+            else:
+                future.set_result(result)
+
+        with self._lock:
+            backend.running -= 1
+            if ran:
+                backend.calls += 1
+                backend.errors += future.exception() is not None
+            self._start_waiting(backend)
+
+    def _start_waiting(self, backend):
+        """Start waiting calls while the backend is under its limit, with the lock held."""
+        while backend.waiting and backend.running < backend.limit:
+            backend.running += 1
+            self._jobs.put((backend, *backend.waiting.popleft()))
+
+    def call(self, name, func, *args, **kwargs):
+        """Call func on a backend thread and return its result.
+
+        Raises BackendTimeout if it didn't return before the backend's deadline.
+        """
+        future = Future()
+        job = (future, func, args, kwargs)
+        with self._lock:
+            backend = self.backends.get(name)
+            if backend is None:
+                backend = self.backends[name] = BackendQueue(
+                    *self.limits.get(name, BACKEND_DEFAULT_LIMITS),
+                )
+            backend.waiting.append(job)
+            backend.max_waiting = max(backend.max_waiting, len(backend.waiting))
+            self._start_waiting(backend)
+
+        try:
+            return future.result(timeout=backend.timeout)
+        except TimeoutError:
+            # raised by func itself, or the call finished just as the wait
+            # timed out; either way, the future has the outcome
+            if future.done():
+                return future.result()
+
+        with self._lock:
+            backend.timeouts += 1
+            # a call handed to a thread already is skipped when the thread
+            # gets to it
+            if future.cancel() and job in backend.waiting:
+                backend.waiting.remove(job)
+        raise BackendTimeout(name, backend.timeout)
+
+    def shutdown(self):
+        """Stop the threads once they finish their current call, dropping waiting calls."""
+        with self._lock:
+            for backend in self.backends.values():
+                for future, _, _, _ in backend.waiting:
+                    future.cancel()
+                backend.waiting.clear()
+        for _ in range(self.workers):
+            self._jobs.put(None)
+
+    def stats(self):
+        with self._lock:
+            return [
+                "{name}: {running}/{limit} running, {waiting} waiting (max {max_waiting}), {calls} calls, {errors} errors, {timeouts} timed out after {timeout:g}s".format(
+                    name=name,
+                    running=backend.running,
+                    limit=backend.limit,
+                    waiting=len(backend.waiting),
+                    max_waiting=backend.max_waiting,
+                    calls=backend.calls,
+                    errors=backend.errors,
+                    timeouts=backend.timeouts,
+                    timeout=backend.timeout,
+                )
+                for name, backend in sorted(self.backends.items())
+            ] or ["no backend calls yet"]
+
+    def metrics(self):
+        """Return the queue depths and call counts in the Prometheus text format."""
+        families = (
+            ("ocf_backend_waiting", "gauge", "Backend calls waiting for a free slot.", lambda b: len(b.waiting)),
+            ("ocf_backend_running", "gauge", "Backend calls running.", lambda b: b.running),
+            ("ocf_backend_calls_total", "counter", "Backend calls run.", lambda b: b.calls),
+            ("ocf_backend_errors_total", "counter", "Backend calls that raised.", lambda b: b.errors),
+            ("ocf_backend_timeouts_total", "counter", "Backend calls given up on.", lambda b: b.timeouts),
+        )
+        lines = []
+        with self._lock:
+            for metric, kind, help_text, value in families:
+                lines.extend((f"# HELP {metric} {help_text}", f"# TYPE {metric} {kind}"))
+                lines.extend(
+                    f'{metric}{{backend="{name}"}} {value(backend)}'
+                    for name, backend in sorted(self.backends.items())
+                )
+        return lines
+
+
+class CommandRunner:
+    """Runs the other OCF plugins' commands and backend calls.
+
+    It's shared with them as bot.memory["ocf_runner"], which they reach
+    through ocfplugins.runner() and ocfplugins.profiled().
+    """
+
+    def __init__(self, stats, executor):
+        self.stats = stats
+        self.executor = executor
+
+    def run(self, func, bot, trigger):
+        """Run a command, timing it for the command stats."""
+        return self.stats.call(func, bot, trigger)
+
+    def call(self, name, func, *args, **kwargs):
+        """Call func on the backend's threads within its deadline, timing the call."""
+        with self.stats.backend(name):
+            return self.executor.call(name, func, *args, **kwargs)
+
+
+def _process_started():
+    """Return when this process started, as a time.time(), or None if that's unknown."""
+    try:
+        with open("/proc/self/stat") as f:
+            # the process name (in parentheses) can contain spaces; starttime is
+            # the 22nd field, in clock ticks after boot
+            start_ticks = int(f.read().rpartition(")")[2].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return time.time() - uptime + start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+@timed_setup
+def setup(bot):
+    bot.settings.define_section("ocf", OCFSection)
+    # keep the command timings and backend threads when the plugin is reloaded
+    if state_outdated(bot, "ocf", STATE_VERSION):
+        previous = bot.memory.get("backend_executor")
+        if previous is not None:
+            previous.shutdown()
+
+        bot.memory["command_stats"] = CommandStats(bot.settings.core.homedir)
+        bot.memory["backend_executor"] = BackendExecutor()
+        bot.memory["ocf_runner"] = CommandRunner(
+            bot.memory["command_stats"],
+            bot.memory["backend_executor"],
+        )
+        state_replaced(bot, "ocf", STATE_VERSION)
+    bot.memory.setdefault("stats", {})["commands"] = command_stats
+    bot.memory["stats"]["backends"] = backend_stats
+    bot.memory.setdefault("metrics", {})["backends"] = backend_metrics
+    bot.memory["stats"]["startup"] = startup_stats
+    bot.memory["metrics"]["startup"] = startup_metrics
+
+    if bot.settings.ocf.metrics_port:
+        server = ThreadingHTTPServer(
+            ("", bot.settings.ocf.metrics_port),
+            metrics_handler(bot),
+        )
+        server.daemon_threads = True
+        bot.memory["ocf_metrics_server"] = server
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+def shutdown(bot):
+    server = bot.memory.pop("ocf_metrics_server", None)
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+
+    # unless the next version takes over the backend threads, the other
+    # plugins go back to calling their backends directly
+    if not reloading(bot, "ocf"):
+        bot.memory.pop("ocf_state", None)
+        bot.memory.pop("ocf_runner", None)
+        executor = bot.memory.pop("backend_executor", None)
+        if executor is not None:
+            executor.shutdown()
+
+
+def metrics_handler(bot):
+    """Make a request handler serving the metrics registered by plugins.
+
+    Like stats, plugins register a function taking the bot and returning
+    lines in the Prometheus text format in bot.memory["metrics"]. Command
+    timings are also served as JSON at /commands.json.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                lines = []
+                for name, func in sorted(bot.memory.get("metrics", {}).items()):
+                    lines.extend(func(bot))
+                body = "".join(line + "\n" for line in lines).encode()
+                content_type = "text/plain; version=0.0.4"
+            elif self.path == "/commands.json":
+                body = json.dumps(bot.memory["command_stats"].summary()).encode()
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
+
+
+def command_stats(bot):
+    """Return the timing of each command, for !stats."""
+    return bot.memory["command_stats"].stats()
+
+
+def backend_stats(bot):
+    """Return the state of each backend's calls, for !stats."""
+    return bot.memory["backend_executor"].stats()
+
+
+def backend_metrics(bot):
+    """Return the backend queue depths and call counts for Prometheus."""
+    return bot.memory["backend_executor"].metrics()
+
+
+def startup_stats(bot):
+    """Return how long each plugin took to load, slowest first, for !stats."""
+    timings = sorted(load_times(), key=lambda timing: timing[1] + timing[2], reverse=True)
+    lines = [
+        f"{name}: import {imported * 1000:.1f}ms, setup {set_up * 1000:.1f}ms"
+        for name, imported, set_up in timings
+    ]
+    connected = bot.memory.get("startup_connected")
+    started = _process_started()
+    if connected is not None and started is not None:
+        lines.append(
+            "connected {:.2f}s after the process started, {:.2f}s of it loading these plugins".format(
+                connected - started,
+                sum(imported + set_up for _, imported, set_up in timings),
+            ),
+        )
+    return lines or ["no plugins loaded yet"]
+
+
+def startup_metrics(bot):
+    """Return the plugins' import and setup() times in the Prometheus text format."""
+    lines = []
+    for step in ("import", "setup"):
+        lines.extend(
+            (
+                f"# HELP ocf_plugin_{step}_seconds Time each plugin took to {step} at startup.",
+                f"# TYPE ocf_plugin_{step}_seconds gauge",
+            ),
+        )
+        for name, imported, set_up in load_times():
+            seconds = imported if step == "import" else set_up
+            lines.append(f'ocf_plugin_{step}_seconds{{plugin="{name}"}} {seconds}')
+    return lines
+
+
+@plugin.event(events.RPL_WELCOME)
+@plugin.unblockable
+def log_startup(bot, trigger):
+    """Log how long the plugins took to load, once the bot is first connected."""
+    if "startup_connected" in bot.memory:
+        # reconnected
+        return
+    bot.memory["startup_connected"] = time.time()
+    for line in startup_stats(bot):
+        LOGGER.info("Startup: %s", line)
+
+
+@plugin.command("profile")
+@plugin.require_admin(reply=True)
+def profile(bot, trigger):
+    """Profile the next call of a command (by function name), or dump timings as JSON.
+
+    profile json writes every command's timings to the bot's home directory.
+    """
+    name = (trigger.group(3) or "").strip()
+    registry = bot.memory["command_stats"]
+
+    if name == "json":
+        path = os.path.join(bot.settings.core.homedir, "command-stats.json")
+        with open(path, "w") as f:
+            json.dump(registry.summary(), f, indent=2, sort_keys=True)
+        bot.reply(f"command timings saved to {path}")
+    elif name:
+        registry.profile(name)
+        bot.reply(f"the next call of {name} will be profiled")
+    else:
+        bot.reply("usage: profile <command function> | profile json")
+
+
+@plugin.command("stats")
+@plugin.require_admin(reply=True)
+def stats(bot, trigger):
+    """Print a plugin's internal statistics, e.g. stats check.
+
+    Plugins can't import each other, so each one registers a function taking
+    the bot and returning lines of text in bot.memory["stats"] from setup().
+    """
+    sections = bot.memory.get("stats", {})
+    name = (trigger.group(3) or "").strip()
+
+    if name not in sections:
+        bot.reply(
+            "stats available for: {}".format(", ".join(sorted(sections)) or "nothing"),
+        )
+        return
+
+    for line in sections[name](bot):
+        bot.reply(line)